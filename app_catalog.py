@@ -0,0 +1,256 @@
+"""Каталог VPN-приложений, общий для бота и прокси-сервера перенаправлений.
+
+Здесь описаны платформы, приложения, ссылки на их скачивание и URL-схемы для
+автоматической настройки. Экраны выбора платформы и приложения собираются
+один раз функцией compile_screens, при нажатии кнопки в них подставляется
+только ссылка пользователя.
+"""
+import json
+
+# Названия платформ для экранов бота
+PLATFORM_NAMES = {
+    'ios': 'iOS/MacOS',
+    'android': 'Android',
+    'pc': 'PC'
+}
+
+# Словарь с URL-схемами для разных приложений
+APP_URL_SCHEMES = {
+    'ios': {
+        'streisand': 'streisand://import/{url}#{name}',
+        'karing': 'karing://install-config?url={url}&name={name}',
+        'foxray': 'foxray://yiguo.dev/sub/add/?url={url}#{name}',
+        'v2box': 'v2box://install-sub?url={url}&name={name}',
+        'singbox': 'sing-box://import-remote-profile?url={url}#{name}',
+        'happ': 'happ://add/{url}'
+    },
+    'android': {
+        'nekoray': 'sn://subscription?url={url}&name={name}',
+        'v2rayng': 'v2rayng://install-sub?url={url}&name={name}',
+        'hiddify': 'hiddify://install-config/?url={url}'
+    },
+    'pc': {
+        'clashx': 'clashx://install-config?url={url}',
+        'clash': 'clash://install-config?url={url}',
+        'hiddify': 'hiddify://install-config/?url={url}'
+    }
+}
+
+# Приложения, для которых бот показывает инструкцию по ручной настройке, хотя URL-схема у них есть
+MANUAL_SETUP_APPS = {
+    ('ios', 'karing'),
+}
+
+# Словарь со ссылками на скачивание приложений, порядок задает порядок кнопок в боте
+APP_DOWNLOAD_LINKS = {
+    'ios': {
+        'streisand': 'https://apps.apple.com/app/streisand/id6450534064',
+        'karing': 'https://apps.apple.com/app/karing/id6472431552',
+        'foxray': 'https://apps.apple.com/app/foxray/id6448898396',
+        'v2box': 'https://apps.apple.com/app/v2box/id6446814690',
+        # 'singbox': 'https://apps.apple.com/app/sing-box/id6450509028',
+        'shadowrocket': 'https://apps.apple.com/app/shadowrocket/id932747118',
+        'happ': 'https://apps.apple.com/app/happ-proxy-utility/id6504287215'
+    },
+    'android': {
+        'v2rayng': 'https://play.google.com/store/apps/details?id=com.v2ray.ang',
+        'hiddify': 'https://play.google.com/store/apps/details?id=app.hiddify.com',
+        'V2RayTun': 'https://play.google.com/store/apps/details?id=com.v2raytun.android',
+    },
+    'pc': {
+        'hiddify': 'https://apps.microsoft.com/detail/9pdfnl3qv2s5',
+        'v2rayN': 'https://github.com/2dust/v2rayN/releases/latest',
+        'karing': 'https://github.com/KaringX/karing/releases/latest'
+    }
+}
+
+# Метка ссылки пользователя в собранной разметке, в JSON она превращается в \u0000link\u0000
+_LINK = "\x00link\x00"
+_LINK_JSON = json.dumps(_LINK)[1:-1]
+
+
+def _button(text, url=None, callback_data=None):
+    button = {'text': text}
+    if url is not None:
+        button['url'] = url
+    if callback_data is not None:
+        button['callback_data'] = callback_data
+    return button
+
+
+class Screen:
+    """Собранный экран бота: текст и JSON клавиатуры с местом для ссылки пользователя.
+
+    Для приложений с автоматической настройкой ссылкой служит адрес /redirect
+    прокси-сервера, для остальных - ссылка на подписку.
+    """
+
+    __slots__ = ('text', 'redirect_prefix', '_markup_parts')
+
+    def __init__(self, text: str, keyboard: list, redirect_prefix: str = None):
+        self.text = text
+        self.redirect_prefix = redirect_prefix
+        markup = json.dumps({'inline_keyboard': keyboard})
+        self._markup_parts = markup.split(_LINK_JSON)
+
+    def render(self, sub_url: str = '', user_name: str = ''):
+        """Возвращает текст и JSON клавиатуры со ссылкой пользователя."""
+        link = sub_url
+        if self.redirect_prefix is not None:
+            link = f"{self.redirect_prefix}{sub_url}&name={user_name}"
+        return self.text, json.dumps(link)[1:-1].join(self._markup_parts)
+
+
+def has_auto_setup(platform: str, app: str) -> bool:
+    return app in APP_URL_SCHEMES.get(platform, {}) and (platform, app) not in MANUAL_SETUP_APPS
+
+
+def _manual_setup_text(platform: str, app: str, app_name: str) -> str:
+    message_text = ""
+    if app == 'V2RayTun':
+        message_text += f"""⚙️ Инструкция по настройке {app_name}:
+
+1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
+2. Откройте приложение {app_name}
+3. Нажмите на кнопку "+" в правом верхнем углу
+4. Выберите "Импорт из буфера обмена"
+
+После добавления конфигурации, нажмите "Подключиться" или "Start"."""
+    elif app == 'v2rayN':
+        message_text += f"""⚙️ Инструкция по настройке {app_name}:
+
+1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
+
+2. В приложении V2RayN нажмите «Сервера» → «Импорт массива URL из буфера обмена».
+
+3. Затем нажмите кнопку «Группа подписки» → «Обновить подписку без прокси». В приложении загрузится список всех доступных локаций.
+
+4. Активируйте VPN:
+   • Выберите нужную вам локацию, кликните по ней правой кнопкой мыши и выберите «Установить как активный сервер».
+   • В нижней части окна приложения установите параметр «Системный прокси» в режим «Установить системный прокси». Иконка приложения изменится на красную - значит, подключение установлено.
+   • Активируйте «Режим VPN» в клиенте. Он находится рядом с параметром «Системный прокси» внизу.
+
+Готово! Теперь на вашем устройстве настроен быстрый и надёжный VPN.
+
+ℹ️ Для отключения VPN:
+   • Смените параметр «Системный прокси» на «Очистить системный прокси»
+   • Выключите «Режим VPN»."""
+    elif app == 'karing':
+        # Добавляем информацию об установке в зависимости от платформы
+        if platform == 'android':
+            message_text += f"""📥 Установка приложения:
+• Скачайте APK-файл по ссылке выше
+• Установите приложение с помощью APK-файла
+
+"""
+        elif platform == 'pc':
+            message_text += f"""📥 Установка приложения:
+• Скачайте установочный файл по ссылке выше
+• Запустите установщик от имени Администратора
+
+"""
+        elif platform == 'ios':
+            message_text += f"""📥 Установка приложения:
+• Установите приложение из App Store по ссылке выше
+
+"""
+
+        message_text += f"""⚙️ Настройка приложения:
+
+1. Запустите приложение "Karing"
+2. Согласитесь с политиками приложения
+3. В разделе "Язык" выберите русский язык и нажмите "Next"
+4. В разделе "Страна или регион" найдите и выберите "Российская Федерация", нажмите "Дальше"
+5. В разделе "Шаблоны личных правил" нажмите "Дальше"
+6. В разделе "Настройка" оставьте переключатель "Режим новичка" включенным, нажмите "Готово"
+
+🔗 Импорт конфигурации:
+1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
+2. В разделе "Добавить профиль" нажмите "Импорт из буфера обмена"
+3. Вверху экрана нажмите на галочку и "Ок" в появившемся окне
+4. Выйдите из раздела "Добавить профиль" нажав на стрелку в левом верхнем углу
+
+🔄 Активация:
+1. Включите приложение с помощью большой кнопки"""
+
+        # Добавляем информацию о первом запуске в зависимости от платформы
+        if platform == 'pc':
+            message_text += f"""
+2. При первом запуске на Windows:
+   • Позвольте доступ к сети
+   • Включите режим работы "Системный прокси"
+   • Выберите режим работы правил перенаправления "Глобально":
+     • "Правила" - через ВПН будут работать только указанные сайты
+     • "Глобально" - через ВПН будут работать все сайты без исключений"""
+        elif platform == 'ios':
+            message_text += f"""
+2. При первом запуске:
+   • Позвольте приложению добавить новый ВПН-профиль в настройки системы
+   • Включите режим работы "Системный прокси"
+   • Выберите режим работы правил перенаправления "Глобально":
+     • "Правила" - через ВПН будут работать только указанные сайты
+     • "Глобально" - через ВПН будут работать все сайты без исключений
+   • Перейдите в настройки iOS/MacOS
+   • Выберите "VPN и управление устройством"
+   • Найдите профиль Karing и нажмите "Установить"
+   • Введите пароль устройства для подтверждения
+   • Нажмите "Установить" в появившемся окне
+   • Вернитесь в приложение Karing"""
+        else:  # android
+            message_text += f"""
+2. Включите режим работы "Системный прокси"
+3. Выберите режим работы правил перенаправления "Глобально":
+   • "Правила" - через ВПН будут работать только указанные сайты
+   • "Глобально" - через ВПН будут работать все сайты без исключений"""
+        
+    else:
+        # Универсальная инструкция для остальных приложений
+        message_text += f"""⚙️ Инструкция по настройке {app_name}:
+
+1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
+2. Откройте приложение {app_name}
+3. Найдите раздел "Импорт" или "Добавить подписку"
+4. Вставьте скопированную ссылку
+5. Сохраните конфигурацию
+6. Включите VPN
+
+ℹ️ Если у вас возникнут проблемы:
+• Убедитесь, что ссылка скопирована полностью
+• Проверьте подключение к интернету
+• Попробуйте перезапустить приложение
+• При необходимости обратитесь к администраторам"""
+
+    return message_text
+
+
+def compile_screens(proxy_url: str):
+    """Собирает экраны выбора платформы и приложения.
+
+    ``proxy_url`` - внешний адрес прокси-сервера перенаправлений, например
+    https://example.com:8443. Возвращает словари platform -> Screen и
+    (platform, app) -> Screen.
+    """
+    platform_screens = {}
+    app_screens = {}
+    for platform, apps in APP_DOWNLOAD_LINKS.items():
+        # Кнопки приложений по одной в ряд, как при InlineKeyboardMarkup.add
+        keyboard = [[_button(app.capitalize(), callback_data=f"app_{platform}_{app}")] for app in apps]
+        keyboard.append([_button("🏠 В главное меню", callback_data="refresh_menu")])
+        platform_screens[platform] = Screen(
+            f"Вы выбрали {PLATFORM_NAMES[platform]}\n\nВыберите приложение:", keyboard)
+
+        for app, download_link in apps.items():
+            app_name = app.capitalize()
+            message_text = f"📱 {app_name}\n\n📥 Скачать приложение: {download_link}\n\n"
+            redirect_prefix = None
+            if has_auto_setup(platform, app):
+                message_text += "🔗 Нажмите кнопку ниже для автоматической настройки:"
+                keyboard = [[_button("⚙️ Настроить автоматически", url=_LINK)]]
+                redirect_prefix = f"{proxy_url}/redirect/{platform}/{app}?url="
+            else:
+                message_text += _manual_setup_text(platform, app, app_name)
+                keyboard = [[_button("🔗 Открыть общую ссылку", url=_LINK)]]
+            keyboard.append([_button("🔙 Назад к выбору приложений", callback_data=f"platform_{platform}")])
+            keyboard.append([_button("🏠 В главное меню", callback_data="refresh_menu")])
+            app_screens[(platform, app)] = Screen(message_text, keyboard, redirect_prefix)
+    return platform_screens, app_screens
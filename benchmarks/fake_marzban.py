@@ -0,0 +1,117 @@
+"""Локальная заглушка API панели Marzban для бенчмарков.
+
+Хранит пользователей SUB_<id> в памяти и поддерживает получение токена,
+get_user, get_users (с offset/limit/status/search), add_user, modify_user
+и remove_user с настраиваемой задержкой ответа.
+"""
+import asyncio
+import base64
+import json
+import time
+
+from aiohttp import web
+
+
+def make_token(ttl: int = 86400) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({'sub': 'admin', 'exp': int(time.time()) + ttl}).encode())
+    return f"eyJhbGciOiJIUzI1NiJ9.{payload.decode().rstrip('=')}.signature"
+
+
+class FakeMarzban:
+    def __init__(self, users: int = 1000, expired_ratio: float = 0.0, stale_ratio: float = 0.5,
+                 latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.users = {}
+        self.populate(users, expired_ratio, stale_ratio)
+
+        self.app = web.Application()
+        self.app.router.add_post('/api/admin/token', self.token)
+        self.app.router.add_get('/api/users', self.get_users)
+        self.app.router.add_post('/api/user', self.add_user)
+        self.app.router.add_get('/api/user/{username}', self.get_user)
+        self.app.router.add_put('/api/user/{username}', self.modify_user)
+        self.app.router.add_delete('/api/user/{username}', self.remove_user)
+
+    def populate(self, users: int, expired_ratio: float = 0.0, stale_ratio: float = 0.5):
+        """Заменяет пользователей панели на ``users`` пользователей SUB_1..SUB_<users>.
+
+        Доля ``expired_ratio`` из них просрочена, а доля ``stale_ratio`` просроченных
+        уже пересекла порог удаления в 30 дней.
+        """
+        now = int(time.time())
+        expired_every = round(1 / expired_ratio) if expired_ratio else 0
+        rows = {}
+        for tg_id in range(1, users + 1):
+            expired = bool(expired_every) and tg_id % expired_every == 0
+            if expired:
+                stale = (tg_id // expired_every) % 100 < stale_ratio * 100
+                expire = now - (40 if stale else 5) * 86400
+            else:
+                expire = now + 20 * 86400
+            username = f"SUB_{tg_id}"
+            rows[username] = self._user(username, 'expired' if expired else 'active', expire, f"User{tg_id}")
+        # Подменяем словарь целиком, чтобы не менять его во время обработки запросов
+        self.users = rows
+
+    @staticmethod
+    def _user(username, status, expire, note=''):
+        return {
+            'username': username, 'status': status, 'expire': expire, 'note': note,
+            'proxies': {'vless': {'flow': 'xtls-rprx-vision'}},
+            'inbounds': {'vless': ['VLESS TCP REALITY']},
+            'data_limit': 0, 'data_limit_reset_strategy': 'no_reset',
+            'subscription_url': f"https://panel.local/sub/{username}",
+        }
+
+    async def _tick(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def token(self, request):
+        await self._tick('token')
+        return web.json_response({'access_token': make_token(), 'token_type': 'bearer'})
+
+    async def get_users(self, request):
+        await self._tick('get_users')
+        query = request.query
+        rows = self.users.values()
+        if 'status' in query:
+            rows = [u for u in rows if u['status'] == query['status']]
+        if 'search' in query:
+            rows = [u for u in rows if query['search'] in u['username']]
+        rows = list(rows)
+        offset = int(query.get('offset', 0))
+        limit = int(query['limit']) if 'limit' in query else len(rows)
+        return web.json_response({'users': rows[offset:offset + limit], 'total': len(rows)})
+
+    async def get_user(self, request):
+        await self._tick('get_user')
+        user = self.users.get(request.match_info['username'])
+        if user is None:
+            return web.json_response({'detail': 'User not found'}, status=404)
+        return web.json_response(user)
+
+    async def add_user(self, request):
+        await self._tick('add_user')
+        data = await request.json()
+        if data['username'] in self.users:
+            return web.json_response({'detail': 'User already exists'}, status=409)
+        user = self.users[data['username']] = self._user(
+            data['username'], data.get('status', 'active'), data.get('expire'), data.get('note', ''))
+        return web.json_response(user)
+
+    async def modify_user(self, request):
+        await self._tick('modify_user')
+        user = self.users.get(request.match_info['username'])
+        if user is None:
+            return web.json_response({'detail': 'User not found'}, status=404)
+        user.update({key: value for key, value in (await request.json()).items() if key in user})
+        return web.json_response(user)
+
+    async def remove_user(self, request):
+        await self._tick('remove_user')
+        if self.users.pop(request.match_info['username'], None) is None:
+            return web.json_response({'detail': 'User not found'}, status=404)
+        return web.json_response({})
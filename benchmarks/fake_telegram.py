@@ -0,0 +1,65 @@
+"""Локальная заглушка Bot API для бенчмарков.
+
+Поддерживает методы, которые вызывает бот на горячих путях, с настраиваемой
+задержкой ответа, долей участников канала и долей ответов 429 с retry_after.
+"""
+import asyncio
+import itertools
+import random
+import time
+import urllib.parse
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, member_ratio: float = 1.0,
+                 flood_ratio: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.member_ratio = member_ratio
+        self.flood_ratio = flood_ratio
+        self.retry_after = retry_after
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self.app.router.add_get('/bot{token}/{method}', self.handle)
+
+    def is_member(self, user_id: int) -> bool:
+        # Детерминированно по ID, чтобы повторные запросы давали один и тот же ответ
+        return (user_id * 2654435761 % 1000) < self.member_ratio * 1000
+
+    def _message(self, chat_id, text=None):
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'}, 'text': text}
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        # pyTelegramBotAPI передает параметры формой даже в GET-запросах
+        params = dict(request.query)
+        params.update(urllib.parse.parse_qsl(await request.text()))
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ('sendMessage', 'editMessageText', 'copyMessage', 'forwardMessage') and random.random() < self.flood_ratio:
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}}, status=429)
+
+        if method == 'getChatMember':
+            user_id = int(params['user_id'])
+            status = 'member' if self.is_member(user_id) else 'left'
+            result = {'status': status, 'user': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}}
+        elif method in ('sendMessage', 'editMessageText', 'forwardMessage'):
+            result = self._message(params.get('chat_id', 0), params.get('text'))
+        elif method == 'copyMessage':
+            result = {'message_id': next(self._message_ids)}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getChat':
+            result = {'id': int(params.get('chat_id', 0)), 'type': 'channel', 'title': 'Bench'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
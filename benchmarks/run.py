@@ -0,0 +1,317 @@
+"""Бенчмарки горячих путей бота против локальных заглушек Bot API и панели Marzban.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.run --users 2000 --tg-latency 0.02 --panel-latency 0.01
+
+Сценарии вызывают настоящие обработчики и задания из bot.py:
+
+* start     - всплеск команд /start от разных пользователей через process_new_updates;
+* broadcast - send_message_to_all_users по всем активным пользователям панели;
+* renewal   - check_tg_and_recharge по просроченным пользователям панели
+              (задержка - проверка одного пользователя до пакетного продления);
+* redirect  - нагрузка на redirect_to_app через uvicorn с proxy_server.app.
+
+Для каждого сценария выводятся пропускная способность, p50/p99 задержки операции,
+p50/p99 запросов к Bot API и пиковое потребление памяти процессом.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import aiohttp
+from aiohttp import web
+from telebot import asyncio_helper
+
+from benchmarks.fake_marzban import FakeMarzban
+from benchmarks.fake_telegram import FakeTelegram
+
+SCENARIOS = ('start', 'broadcast', 'renewal', 'redirect')
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Stubs:
+    """Заглушки Telegram и Marzban в отдельном потоке со своим циклом событий.
+
+    Так время ответа заглушек не смешивается с работой бота в основном цикле.
+    """
+
+    def __init__(self, telegram: FakeTelegram, marzban: FakeMarzban):
+        self.telegram = telegram
+        self.marzban = marzban
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.telegram_port = self.call(self._serve(self.telegram.app))
+        self.marzban_port = self.call(self._serve(self.marzban.app))
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @staticmethod
+    async def _serve(app, port=0):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', port)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+
+class Recorder:
+    """Собирает длительности запросов к Bot API по методам."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def install(self, asyncio_helper):
+        process_request = asyncio_helper._process_request
+
+        async def recorded(token, url, *args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await process_request(token, url, *args, **kwargs)
+            finally:
+                self.samples.setdefault(url, []).append(time.perf_counter() - started_at)
+
+        asyncio_helper._process_request = recorded
+
+    def reset(self):
+        self.samples = {}
+
+
+def configure_env(args, telegram_port, marzban_port, workdir):
+    """Задает переменные окружения для импорта bot.py."""
+    os.environ.update(
+        BOT_TOKEN='123456:bench',
+        TARGET_CHANNEL='-1001',
+        CHECK_COOLDOWN='60',
+        PANEL_USERNAME='admin',
+        PANEL_PASS='admin',
+        PANEL_ADDRESS=f'http://127.0.0.1:{marzban_port}',
+        PROXY_DOMAIN='bench.local',
+        PROXY_PORT='443',
+        DATA_DIR=os.path.join(workdir, 'data'),
+        LOG_DIR=os.path.join(workdir, 'log'),
+        LOG_LEVEL=args.log_level,
+        METRICS_PORT='0',
+        BROADCAST_RATE=str(args.broadcast_rate),
+    )
+
+
+def make_start_update(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+        'from': user,
+    }}
+
+
+async def bench_start(bot, args, stubs, recorder):
+    """Всплеск /start: каждое обновление обрабатывается целиком, от разбора до ответа."""
+    stubs.marzban.populate(args.users)
+    updates = [bot.types.Update.de_json(make_start_update(i, i)) for i in range(1, args.start_burst + 1)]
+    limit = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def process(update):
+        async with limit:
+            started_at = time.perf_counter()
+            await bot.bot.process_new_updates([update])
+            latencies.append(time.perf_counter() - started_at)
+
+    await asyncio.gather(*(process(update) for update in updates))
+    return len(updates), latencies
+
+
+async def bench_broadcast(bot, args, stubs, recorder):
+    stubs.marzban.populate(args.users)
+    success, fail, skipped = await bot.send_message_to_all_users('Бенчмарк рассылки')
+    # Задержка доставки одного сообщения - это задержка sendMessage с учетом ожидания лимитов
+    return success + fail + skipped, recorder.samples.get('sendMessage', [])
+
+
+async def bench_renewal(bot, args, stubs, recorder):
+    stubs.marzban.populate(args.users, expired_ratio=args.expired_ratio)
+    latencies = []
+    review_expired_user = bot.review_expired_user
+
+    async def timed_review(*a, **kw):
+        started_at = time.perf_counter()
+        try:
+            return await review_expired_user(*a, **kw)
+        finally:
+            latencies.append(time.perf_counter() - started_at)
+
+    # check_tg_and_recharge вызывает review_expired_user через глобальное имя модуля
+    bot.review_expired_user = timed_review
+    try:
+        stats = await bot.check_tg_and_recharge()
+    finally:
+        bot.review_expired_user = review_expired_user
+    return sum(stats.values()), latencies
+
+
+async def bench_redirect(bot, args, stubs, recorder):
+    import uvicorn
+    import proxy_server
+
+    config = uvicorn.Config(proxy_server.app, host='127.0.0.1', port=args.redirect_port,
+                            log_level='warning', access_log=False)
+    server = uvicorn.Server(config)
+    # Сервер работает в потоке заглушек, клиенты - в основном цикле
+    serving = asyncio.run_coroutine_threadsafe(server.serve(), stubs.loop)
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    url = f'http://127.0.0.1:{args.redirect_port}/redirect/ios/streisand'
+    latencies = []
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            limit = asyncio.Semaphore(args.concurrency)
+
+            async def fetch(i):
+                params = {'url': f'https://panel.local/sub/SUB_{i % args.users}', 'name': 'SubVPN'}
+                async with limit:
+                    started_at = time.perf_counter()
+                    async with session.get(url, params=params) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            raise RuntimeError(f'redirect вернул {resp.status}')
+                    latencies.append(time.perf_counter() - started_at)
+
+            await asyncio.gather(*(fetch(i) for i in range(args.redirect_requests)))
+    finally:
+        server.should_exit = True
+        await asyncio.wrap_future(serving)
+    return args.redirect_requests, latencies
+
+
+BENCHMARKS = {
+    'start': bench_start,
+    'broadcast': bench_broadcast,
+    'renewal': bench_renewal,
+    'redirect': bench_redirect,
+}
+
+
+async def run(args, bot, stubs, recorder):
+    results = []
+    await bot.panel.start()
+    for name in args.scenarios:
+        # Каждый сценарий начинается с холодных кешей
+        bot.membership_cache.clear()
+        bot.sub_url_cache.clear()
+        recorder.reset()
+        if args.tracemalloc:
+            tracemalloc.reset_peak()
+        started_at = time.perf_counter()
+        operations, latencies = await BENCHMARKS[name](bot, args, stubs, recorder)
+        elapsed = time.perf_counter() - started_at
+        api_latencies = [sample for samples in recorder.samples.values() for sample in samples]
+        result = {
+            'scenario': name,
+            'operations': operations,
+            'seconds': round(elapsed, 3),
+            'ops_per_second': round(operations / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'api_calls': {method: len(samples) for method, samples in recorder.samples.items()},
+            'api_p50_ms': round(percentile(api_latencies, 0.50) * 1000, 2),
+            'api_p99_ms': round(percentile(api_latencies, 0.99) * 1000, 2),
+            # ru_maxrss в Linux измеряется в килобайтах
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        if args.tracemalloc:
+            result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        results.append(result)
+        print(format_result(result), flush=True)
+
+    if asyncio_helper.session_manager.session is not None:
+        await bot.bot.close_session()
+    await bot.panel.close()
+    return results
+
+
+def format_result(result):
+    line = (f"{result['scenario']:<10} {result['operations']:>7} оп. за {result['seconds']:>7.2f} сек "
+            f"{result['ops_per_second']:>9.1f} оп/сек  p50 {result['p50_ms']:>8.2f} мс  p99 {result['p99_ms']:>8.2f} мс  "
+            f"API p50 {result['api_p50_ms']:>7.2f} мс  p99 {result['api_p99_ms']:>7.2f} мс  "
+            f"RSS {result['peak_rss_mb']:>7.1f} МБ")
+    if 'peak_traced_mb' in result:
+        line += f"  Python {result['peak_traced_mb']:.1f} МБ"
+    return line
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"сценарии для запуска: {', '.join(SCENARIOS)}; по умолчанию все")
+    parser.add_argument('--users', type=int, default=1000, help='пользователей в панели')
+    parser.add_argument('--start-burst', type=int, default=500, help='команд /start во всплеске')
+    parser.add_argument('--expired-ratio', type=float, default=1.0, help='доля просроченных пользователей для renewal')
+    parser.add_argument('--redirect-requests', type=int, default=5000, help='запросов к redirect_to_app')
+    parser.add_argument('--redirect-port', type=int, default=18080, help='порт uvicorn для сценария redirect')
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременных операций в start и redirect')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='задержка ответа Bot API, сек')
+    parser.add_argument('--panel-latency', type=float, default=0.01, help='задержка ответа панели, сек')
+    parser.add_argument('--member-ratio', type=float, default=0.8, help='доля участников канала')
+    parser.add_argument('--flood-ratio', type=float, default=0.0, help='доля ответов 429 на отправку сообщений')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, сек')
+    parser.add_argument('--broadcast-rate', type=float, default=1000, help='BROADCAST_RATE для рассылки')
+    parser.add_argument('--log-level', default='ERROR', help='LOG_LEVEL бота')
+    parser.add_argument('--tracemalloc', action='store_true', help='также измерять пик памяти Python (медленнее)')
+    parser.add_argument('--json', metavar='PATH', help='сохранить результаты в JSON для сравнения запусков')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stubs = Stubs(
+        FakeTelegram(latency=args.tg_latency, member_ratio=args.member_ratio,
+                     flood_ratio=args.flood_ratio, retry_after=args.retry_after),
+        FakeMarzban(users=args.users, latency=args.panel_latency),
+    )
+    stubs.start()
+
+    with tempfile.TemporaryDirectory(prefix='subvpn_bench_') as workdir:
+        configure_env(args, stubs.telegram_port, stubs.marzban_port, workdir)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import bot
+
+        asyncio_helper.API_URL = f'http://127.0.0.1:{stubs.telegram_port}/bot{{0}}/{{1}}'
+        recorder = Recorder()
+        recorder.install(asyncio_helper)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        results = asyncio.run(run(args, bot, stubs, recorder))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
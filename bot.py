@@ -1,31 +1,55 @@
 import asyncio
+import atexit
 import datetime
+import hashlib
 import logging
 import os
+import queue
+import signal
+import time
+from collections import Counter
 from datetime import timedelta
 import urllib.parse
-from logging.handlers import RotatingFileHandler
+import weakref
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import aiohttp
+import httpx
 import telebot
-from scheduler.asyncio import Scheduler
-from telebot import types
+import uvicorn
+from aiohttp import web
+from telebot import asyncio_helper, types
 from telebot.async_telebot import AsyncTeleBot
 from telebot.util import user_link
-from marzban import MarzbanAPI, UserCreate, UserModify, ProxySettings
+from marzban import MarzbanAPI, UserCreate, ProxySettings
+
+from broadcast import BroadcastEngine, BroadcastStore
+from app_catalog import compile_screens
+from cache import TTLCache
+from dispatch import UpdateGate
+from expiry_schedule import ExpirySchedule
+from jobs import JobScheduler
+from marzban_client import MarzbanClient
+from metrics import REGISTRY, timed
+from proxy_server import add_telegram_webhook, app as web_app, find_ssl_files
+from renewal_queue import RenewalQueue
+from renewal_store import RenewalStateStore, needs_check
+from sessions import MemorySessionStore, SQLiteSessionStore
+from support_relay import SupportRelayStore
 
 # Настройка логирования
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
-LOG_DIR = '/var/log'
+LOG_DIR = os.environ.get('LOG_DIR', '/var/log')
 LOG_MAX_BYTES = 10 * 1024 * 1024  # 10 MB
 LOG_BACKUP_COUNT = 5
+LOG_UPDATES_RATE = float(os.environ.get('LOG_UPDATES_RATE', 20))  # Лимит записей журнала по отдельным сообщениям в секунду, 0 - без лимита
 
 # Создаем директорию для логов, если она не существует
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # Настраиваем логгер
-logger = logging.getLogger(__name__)
+logger = logging.getLogger('subvpn')
 logger.setLevel(LOG_LEVEL)
 
 # Форматтер для логов
@@ -41,14 +65,74 @@ file_handler = RotatingFileHandler(
 file_handler.setFormatter(formatter)
 file_handler.setLevel(logging.INFO)
 
-# Добавляем обработчик к логгеру
-logger.addHandler(file_handler)
-
 # Также выводим логи в консоль
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
 console_handler.setLevel(LOG_LEVEL)
-logger.addHandler(console_handler)
+
+# Запись на диск и в консоль выполняется в отдельном потоке, чтобы не блокировать цикл событий
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+class RateLimitFilter(logging.Filter):
+    """Пропускает не более ``rate`` записей в секунду, ошибки пропускаются всегда.
+
+    Число отброшенных записей добавляется к первой записи после паузы.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._suppressed = 0
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens < 1:
+            self._suppressed += 1
+            return False
+        self._tokens -= 1
+        if self._suppressed:
+            record.msg = f"{record.getMessage()} (пропущено записей журнала: {self._suppressed})"
+            record.args = None
+            self._suppressed = 0
+        return True
+
+
+# Логгер для записей по каждому сообщению и получателю рассылки, с ограничением частоты
+update_logger = logging.getLogger('subvpn.updates')
+update_logger.addFilter(RateLimitFilter(LOG_UPDATES_RATE))
+
+# Метрики
+HANDLER_LATENCY = REGISTRY.histogram('subvpn_handler_duration_seconds', 'Длительность обработчиков обновлений')
+BOT_API_REQUESTS = REGISTRY.histogram('subvpn_bot_api_request_duration_seconds', 'Длительность запросов к Bot API')
+RENEWAL_DURATION = REGISTRY.histogram('subvpn_renewal_run_duration_seconds', 'Длительность проверки и продления подписок')
+RENEWAL_USERS = REGISTRY.counter('subvpn_renewal_users_total', 'Пользователи, обработанные при проверке подписок')
+REGISTRY.gauge('subvpn_log_queue_depth', 'Записи журнала, ожидающие записи на диск', log_queue.qsize)
+
+
+async def _timed_process_request(token, url, *args, _process_request=asyncio_helper._process_request, **kwargs):
+    """Выполняет запрос к Bot API, записывая его длительность по имени метода."""
+    started_at = time.perf_counter()
+    outcome = 'error'
+    try:
+        result = await _process_request(token, url, *args, **kwargs)
+        outcome = 'ok'
+        return result
+    finally:
+        BOT_API_REQUESTS.observe(time.perf_counter() - started_at, method=url, outcome=outcome)
+
+# Все методы AsyncTeleBot обращаются к Bot API через asyncio_helper._process_request
+asyncio_helper._process_request = _timed_process_request
 
 # Загрузка переменных окружения
 target_channel = int(os.environ['TARGET_CHANNEL'])
@@ -62,6 +146,43 @@ proxy_port = os.environ['PROXY_PORT']
 admin_ids = [int(id.strip()) for id in os.environ.get('ADMIN_ID', '').split(',') if id.strip()]
 SUPPORT_CHAT_ID = int(os.environ.get('SUPPORT_CHAT_ID', 0))  # ID чата для поддержки
 SUPPORT_BOT_USERNAME = os.environ.get('SUPPORT_BOT_USERNAME', '')  # Username бота поддержки
+MEMBERSHIP_CACHE_TTL = int(os.environ.get('MEMBERSHIP_CACHE_TTL', 300))  # Время жизни кеша подписки на канал, сек
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 10000))  # Максимум записей в кеше подписки
+SUB_URL_CACHE_TTL = int(os.environ.get('SUB_URL_CACHE_TTL', 86400))  # Время жизни кеша ссылок на подписку, сек
+SUB_URL_CACHE_SIZE = int(os.environ.get('SUB_URL_CACHE_SIZE', 10000))  # Максимум записей в кеше ссылок
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 20))  # Число параллельных воркеров рассылки
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))  # Лимит сообщений рассылки в секунду
+RENEWAL_CHECK_CONCURRENCY = int(os.environ.get('RENEWAL_CHECK_CONCURRENCY', 10))  # Параллельных проверок подписки при продлении
+RENEWAL_PANEL_CONCURRENCY = int(os.environ.get('RENEWAL_PANEL_CONCURRENCY', 5))  # Параллельных запросов к панели при продлении
+RENEWAL_INCREMENTAL = os.environ.get('RENEWAL_INCREMENTAL', 'true').lower() in ('1', 'true', 'yes')  # Обрабатывать только изменившихся пользователей
+RENEWAL_RECHECK_INTERVAL = int(os.environ.get('RENEWAL_RECHECK_INTERVAL', 360))  # Через сколько минут перепроверять подписку просроченных, мин
+INSTANT_RENEWAL_RATE = float(os.environ.get('INSTANT_RENEWAL_RATE', 5))  # Лимит продлений при вступлении в канал в секунду
+INSTANT_RENEWAL_COOLDOWN = int(os.environ.get('INSTANT_RENEWAL_COOLDOWN', 60))  # Не продлевать одного пользователя по событию чаще, сек
+RENEWAL_TIMEOUT = int(os.environ.get('RENEWAL_TIMEOUT', 3600))  # Максимальная длительность проверки подписок, сек, 0 - без ограничения
+JOB_JITTER = float(os.environ.get('JOB_JITTER', 30))  # Случайная задержка старта периодических задач, сек
+JOB_SHUTDOWN_GRACE = float(os.environ.get('JOB_SHUTDOWN_GRACE', 20))  # Сколько ждать завершения задач при остановке бота, сек
+PANEL_PAGE_SIZE = int(os.environ.get('PANEL_PAGE_SIZE', 500))  # Размер страницы при чтении пользователей панели
+PANEL_MAX_CONNECTIONS = int(os.environ.get('PANEL_MAX_CONNECTIONS', 20))  # Максимум одновременных соединений с панелью
+PANEL_TIMEOUT = float(os.environ.get('PANEL_TIMEOUT', 15))  # Таймаут запроса к панели вместе с ожиданием соединения, сек
+# Дополнительные типы обновлений через запятую, например chat_member, если нет обработчика
+EXTRA_ALLOWED_UPDATES = [t.strip() for t in os.environ.get('EXTRA_ALLOWED_UPDATES', '').split(',') if t.strip()]
+UPDATE_MODE = os.environ.get('UPDATE_MODE', 'polling').lower()  # Способ получения обновлений: polling или webhook
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))  # Порт для приема webhook от Telegram (443, 80, 88 или 8443)
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(bot_token.encode()).hexdigest()[:32]  # Секрет в пути и заголовке webhook
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or f"https://{proxy_domain}:{WEBHOOK_PORT}/telegram/{WEBHOOK_SECRET}"  # Публичный адрес webhook
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))  # Максимум необработанных обновлений в очереди
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))  # Максимум одновременных соединений Telegram с webhook
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 50))  # Максимум одновременно обрабатываемых обновлений
+UPDATE_BUSY_WAIT = float(os.environ.get('UPDATE_BUSY_WAIT', 2))  # Сколько нажатие кнопки ждет свободного места до ответа «занято», сек
+UPDATE_USER_QUEUE = int(os.environ.get('UPDATE_USER_QUEUE', 5))  # Сколько сообщений пользователя в очереди, после которых отбрасываются повторы команд
+DATA_DIR = os.environ.get('DATA_DIR', '/var/lib/subvpn_bot')  # Каталог для локальных данных бота
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')  # Адрес HTTP-сервера метрик
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))  # Порт метрик Prometheus (/metrics), 0 - отключить
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite').lower()  # Хранилище сессий: sqlite или memory
+SESSION_DB = os.environ.get('SESSION_DB', os.path.join(DATA_DIR, 'sessions.db'))  # Файл базы сессий, может быть общим для нескольких ботов
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 30 * 86400))  # Время жизни неактивной сессии, сек
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))  # Максимум сессий в памяти для SESSION_BACKEND=memory
+SUPPORT_RELAY_TTL = int(os.environ.get('SUPPORT_RELAY_TTL', 90 * 86400))  # Сколько помнить автора сообщений в чате поддержки, сек
 
 # Логируем важные переменные при запуске
 logger.info(f"Загруженные переменные окружения:")
@@ -69,65 +190,71 @@ logger.info(f"SUPPORT_CHAT_ID: {SUPPORT_CHAT_ID}")
 logger.info(f"SUPPORT_BOT_USERNAME: {SUPPORT_BOT_USERNAME}")
 logger.info(f"ADMIN_IDS: {admin_ids}")
 
-# Словарь с URL-схемами для разных приложений
-APP_URL_SCHEMES = {
-    'ios': {
-        'streisand': 'streisand://import/{url}#{name}',
-        # 'karing': 'karing://install-config?url={url}&name={name}',  # Закомментировали URL-схему для Karing
-        'foxray': 'foxray://yiguo.dev/sub/add/?url={url}#{name}',
-        'v2box': 'v2box://install-sub?url={url}&name={name}',
-        'singbox': 'sing-box://import-remote-profile?url={url}#{name}'
-    },
-    'android': {
-        'v2rayng': 'v2rayng://install-sub?url={url}&name={name}',
-        'hiddify': 'hiddify://install-config/?url={url}'
-    },
-    'pc': {
-        'hiddify': 'hiddify://install-config/?url={url}'
-    }
+# Типы обновлений Telegram, соответствующие спискам обработчиков AsyncTeleBot
+HANDLER_UPDATE_TYPES = {
+    'message_handlers': 'message',
+    'edited_message_handlers': 'edited_message',
+    'channel_post_handlers': 'channel_post',
+    'edited_channel_post_handlers': 'edited_channel_post',
+    'message_reaction_handlers': 'message_reaction',
+    'message_reaction_count_handlers': 'message_reaction_count',
+    'inline_handlers': 'inline_query',
+    'chosen_inline_handlers': 'chosen_inline_result',
+    'callback_query_handlers': 'callback_query',
+    'shipping_query_handlers': 'shipping_query',
+    'pre_checkout_query_handlers': 'pre_checkout_query',
+    'poll_handlers': 'poll',
+    'poll_answer_handlers': 'poll_answer',
+    'my_chat_member_handlers': 'my_chat_member',
+    'chat_member_handlers': 'chat_member',
+    'chat_join_request_handlers': 'chat_join_request',
+    'removed_chat_boost_handlers': 'removed_chat_boost',
+    'chat_boost_handlers': 'chat_boost',
+    'business_connection_handlers': 'business_connection',
+    'business_message_handlers': 'business_message',
+    'edited_business_message_handlers': 'edited_business_message',
+    'deleted_business_messages_handlers': 'deleted_business_messages',
 }
 
-# Словарь со ссылками на скачивание приложений
-APP_DOWNLOAD_LINKS = {
-    'ios': {
-        'streisand': 'https://apps.apple.com/app/streisand/id6450534064',
-        'karing': 'https://apps.apple.com/app/karing/id6472431552',
-        'foxray': 'https://apps.apple.com/app/foxray/id6448898396',
-        'v2box': 'https://apps.apple.com/app/v2box/id6446814690',
-        # 'singbox': 'https://apps.apple.com/app/sing-box/id6450509028',
-        'shadowrocket': 'https://apps.apple.com/app/shadowrocket/id932747118',
-        'happ': 'https://apps.apple.com/app/happ-proxy-utility/id6504287215'
-    },
-    'android': {
-        'v2rayng': 'https://play.google.com/store/apps/details?id=com.v2ray.ang',
-        'hiddify': 'https://play.google.com/store/apps/details?id=app.hiddify.com',
-        'V2RayTun': 'https://play.google.com/store/apps/details?id=com.v2raytun.android',
-    },
-    'pc': {
-        'hiddify': 'https://apps.microsoft.com/detail/9pdfnl3qv2s5',
-        'v2rayN': 'https://github.com/2dust/v2rayN/releases/latest',
-        'karing': 'https://github.com/KaringX/karing/releases/latest'
-    }
-}
+# Статусы участника канала, дающие доступ к VPN
+MEMBER_STATUSES = ('member', 'administrator', 'creator', 'restricted')
 
-async def generate_app_specific_link(base_url: str, system: str, app: str, user_name: str) -> str:
-    """Генерирует специфическую ссылку для выбранного приложения через прокси-сервер."""
-    if system not in APP_URL_SCHEMES or app not in APP_URL_SCHEMES[system]:
-        return base_url
-    
-    # Формируем URL для прокси-сервера
-    proxy_url = f"https://{proxy_domain}:{proxy_port}/redirect/{system}/{app}"
-    
-    # Для всех приложений используем прямой формат без кодирования
-    return f"{proxy_url}?url={base_url}&name={user_name}"
+# Экраны выбора платформы и приложения, собранные один раз при запуске
+PLATFORM_SCREENS, APP_SCREENS = compile_screens(f"https://{proxy_domain}:{proxy_port}")
 
 # Инициализация API и бота
 api = MarzbanAPI(base_url=panel_address)
+panel = MarzbanClient(api, panel_username, panel_pass,
+                      max_connections=PANEL_MAX_CONNECTIONS, call_timeout=PANEL_TIMEOUT)
 bot = AsyncTeleBot(bot_token)
-bot.user_data = {}
+# Одно обновление на пользователя и общий лимит параллельной обработки
+bot.setup_middleware(UpdateGate(bot, max_concurrent=UPDATE_CONCURRENCY, max_wait=UPDATE_BUSY_WAIT,
+                                max_pending_per_user=UPDATE_USER_QUEUE))
+# Сессии пользователей: ссылка на подписку и флаг режима поддержки
+if SESSION_BACKEND == 'memory':
+    sessions = MemorySessionStore(ttl=SESSION_TTL, maxsize=SESSION_CACHE_SIZE)
+else:
+    sessions = SQLiteSessionStore(SESSION_DB, ttl=SESSION_TTL)
+# Кеш результатов get_chat_member: user_id -> ChatMember или False
+membership_cache = TTLCache(ttl=MEMBERSHIP_CACHE_TTL, maxsize=MEMBERSHIP_CACHE_SIZE)
+# Кеш ссылок на подписку: tg_user_id -> subscription_url пользователя SUB_<tg_user_id>
+sub_url_cache = TTLCache(ttl=SUB_URL_CACHE_TTL, maxsize=SUB_URL_CACHE_SIZE)
+# Журнал заданий рассылки и номера выполняющихся сейчас заданий
+broadcast_store = BroadcastStore(os.path.join(DATA_DIR, 'broadcasts.db'))
+active_broadcasts = set()
+REGISTRY.gauge('subvpn_active_broadcasts', 'Выполняющиеся задания рассылки', lambda: len(active_broadcasts))
+# Последнее известное состояние пользователей для инкрементальной проверки подписок
+renewal_state = RenewalStateStore(os.path.join(DATA_DIR, 'renewal.db'))
+# Сроки подписки пользователей SUB_: бот просыпается ровно к ближайшему из них
+expiry_schedule = ExpirySchedule(removal_age=timedelta(days=30).total_seconds())
+# Авторы сообщений, пересланных в чат поддержки: (chat_id, message_id) -> user_id
+support_relay = SupportRelayStore(os.path.join(DATA_DIR, 'support.db'), ttl=SUPPORT_RELAY_TTL)
+# Блокировки пользователей панели, чтобы продление по событию и удаление не пересекались
+panel_user_locks = weakref.WeakValueDictionary()
 # panel = Marzban(panel_username, panel_pass, panel_address)
 
 @bot.message_handler(commands=['vpn', 'start'])
+@timed(HANDLER_LATENCY, handler='vpn_message')
 async def vpn_message(message):
     if message.chat.type != 'private':
         return
@@ -139,7 +266,7 @@ async def vpn_message(message):
         sub_link = await get_marzban_sub_url(tg_user_id, tg_user.user.full_name)
         
         # Сохраняем ссылку в сессии пользователя
-        bot.user_data[message.from_user.id] = {'sub_link': sub_link}
+        await sessions.set(message.from_user.id, {'sub_link': sub_link})
         
         welcome_message += """🎉 Добро пожаловать в бота SubVPN!
 
@@ -184,199 +311,51 @@ async def vpn_message(message):
         await bot.send_message(message.chat.id, text=welcome_message, reply_markup=keyboardmain, parse_mode='HTML')
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('platform_'))
+@timed(HANDLER_LATENCY, handler='handle_platform_selection')
 async def handle_platform_selection(call):
     """Обработчик выбора платформы."""
     if call.message.chat.type != 'private':
         return
-    platform = call.data.split('_')[1]
-    platform_names = {
-        'ios': 'iOS/MacOS',
-        'android': 'Android',
-        'pc': 'PC'
-    }
-    
-    # Создаем inline-кнопки для приложений
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for app in APP_DOWNLOAD_LINKS[platform].keys():
-        markup.add(types.InlineKeyboardButton(
-            text=app.capitalize(),
-            callback_data=f"app_{platform}_{app}"
-        ))
-    markup.add(types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="refresh_menu"))
+    screen = PLATFORM_SCREENS.get(call.data.split('_')[1])
+    if screen is None:
+        await bot.answer_callback_query(call.id, "Эта платформа больше не поддерживается")
+        return
     
+    text, markup = screen.render()
     await bot.edit_message_text(
-        f"Вы выбрали {platform_names[platform]}\n\nВыберите приложение:",
+        text,
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         reply_markup=markup
     )
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('app_'))
+@timed(HANDLER_LATENCY, handler='handle_app_selection')
 async def handle_app_selection(call):
     """Обработчик выбора приложения."""
     if call.message.chat.type != 'private':
         return
     _, platform, app = call.data.split('_')
-    app_name = app.capitalize()
+    screen = APP_SCREENS.get((platform, app))
+    if screen is None:
+        await bot.answer_callback_query(call.id, "Это приложение больше не поддерживается, выберите другое")
+        return
     
-    if call.from_user.id not in bot.user_data or 'sub_link' not in bot.user_data[call.from_user.id]:
+    base_url = (await sessions.get(call.from_user.id)).get('sub_link')
+    if not base_url:
         await bot.answer_callback_query(call.id, "Ошибка: не удалось найти вашу ссылку. Пожалуйста, начните заново с команды /start")
         return
     
-    base_url = bot.user_data[call.from_user.id]['sub_link']
-    
-    # Создаем сообщение с информацией о приложении
-    message_text = f"📱 {app_name}\n\n"
-    
-    # Добавляем ссылку на скачивание
-    download_link = APP_DOWNLOAD_LINKS[platform][app]
-    message_text += f"📥 Скачать приложение: {download_link}\n\n"
-    
-    # Создаем markup в начале
-    markup = types.InlineKeyboardMarkup()
-    
-    # Проверяем, есть ли URL-схема для приложения
-    if platform in APP_URL_SCHEMES and app in APP_URL_SCHEMES[platform]:
-        # Генерируем специфическую ссылку
-        app_link = await generate_app_specific_link(
-            base_url,
-            platform,
-            app,
-            f"SubVPN_{call.from_user.id}"
-        )
-        message_text += f"🔗 Нажмите кнопку ниже для автоматической настройки:"
-        markup.add(types.InlineKeyboardButton(text="⚙️ Настроить автоматически", url=app_link))
-    else:
-        # Показываем инструкцию для ручного добавления
-        if app == 'V2RayTun':
-            message_text += f"""⚙️ Инструкция по настройке {app_name}:
-
-1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
-2. Откройте приложение {app_name}
-3. Нажмите на кнопку "+" в правом верхнем углу
-4. Выберите "Импорт из буфера обмена"
-
-После добавления конфигурации, нажмите "Подключиться" или "Start"."""
-            markup.add(types.InlineKeyboardButton(text="🔗 Открыть общую ссылку", url=base_url))
-        elif app == 'v2rayN':
-            message_text += f"""⚙️ Инструкция по настройке {app_name}:
-
-1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
-
-2. В приложении V2RayN нажмите «Сервера» → «Импорт массива URL из буфера обмена».
-
-3. Затем нажмите кнопку «Группа подписки» → «Обновить подписку без прокси». В приложении загрузится список всех доступных локаций.
-
-4. Активируйте VPN:
-   • Выберите нужную вам локацию, кликните по ней правой кнопкой мыши и выберите «Установить как активный сервер».
-   • В нижней части окна приложения установите параметр «Системный прокси» в режим «Установить системный прокси». Иконка приложения изменится на красную - значит, подключение установлено.
-   • Активируйте «Режим VPN» в клиенте. Он находится рядом с параметром «Системный прокси» внизу.
-
-Готово! Теперь на вашем устройстве настроен быстрый и надёжный VPN.
-
-ℹ️ Для отключения VPN:
-   • Смените параметр «Системный прокси» на «Очистить системный прокси»
-   • Выключите «Режим VPN»."""
-            markup.add(types.InlineKeyboardButton(text="🔗 Открыть общую ссылку", url=base_url))
-        elif app == 'karing':
-            # Добавляем информацию об установке в зависимости от платформы
-            if platform == 'android':
-                message_text += f"""📥 Установка приложения:
-• Скачайте APK-файл по ссылке выше
-• Установите приложение с помощью APK-файла
-
-"""
-            elif platform == 'pc':
-                message_text += f"""📥 Установка приложения:
-• Скачайте установочный файл по ссылке выше
-• Запустите установщик от имени Администратора
-
-"""
-            elif platform == 'ios':
-                message_text += f"""📥 Установка приложения:
-• Установите приложение из App Store по ссылке выше
-
-"""
-
-            message_text += f"""⚙️ Настройка приложения:
-
-1. Запустите приложение "Karing"
-2. Согласитесь с политиками приложения
-3. В разделе "Язык" выберите русский язык и нажмите "Next"
-4. В разделе "Страна или регион" найдите и выберите "Российская Федерация", нажмите "Дальше"
-5. В разделе "Шаблоны личных правил" нажмите "Дальше"
-6. В разделе "Настройка" оставьте переключатель "Режим новичка" включенным, нажмите "Готово"
-
-🔗 Импорт конфигурации:
-1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
-2. В разделе "Добавить профиль" нажмите "Импорт из буфера обмена"
-3. Вверху экрана нажмите на галочку и "Ок" в появившемся окне
-4. Выйдите из раздела "Добавить профиль" нажав на стрелку в левом верхнем углу
-
-🔄 Активация:
-1. Включите приложение с помощью большой кнопки"""
-
-            # Добавляем информацию о первом запуске в зависимости от платформы
-            if platform == 'pc':
-                message_text += f"""
-2. При первом запуске на Windows:
-   • Позвольте доступ к сети
-   • Включите режим работы "Системный прокси"
-   • Выберите режим работы правил перенаправления "Глобально":
-     • "Правила" - через ВПН будут работать только указанные сайты
-     • "Глобально" - через ВПН будут работать все сайты без исключений"""
-            elif platform == 'ios':
-                message_text += f"""
-2. При первом запуске:
-   • Позвольте приложению добавить новый ВПН-профиль в настройки системы
-   • Включите режим работы "Системный прокси"
-   • Выберите режим работы правил перенаправления "Глобально":
-     • "Правила" - через ВПН будут работать только указанные сайты
-     • "Глобально" - через ВПН будут работать все сайты без исключений
-   • Перейдите в настройки iOS/MacOS
-   • Выберите "VPN и управление устройством"
-   • Найдите профиль Karing и нажмите "Установить"
-   • Введите пароль устройства для подтверждения
-   • Нажмите "Установить" в появившемся окне
-   • Вернитесь в приложение Karing"""
-            else:  # android
-                message_text += f"""
-2. Включите режим работы "Системный прокси"
-3. Выберите режим работы правил перенаправления "Глобально":
-   • "Правила" - через ВПН будут работать только указанные сайты
-   • "Глобально" - через ВПН будут работать все сайты без исключений"""
-            
-            markup.add(types.InlineKeyboardButton(text="🔗 Открыть общую ссылку", url=base_url))
-        else:
-            # Универсальная инструкция для остальных приложений
-            message_text += f"""⚙️ Инструкция по настройке {app_name}:
-
-1. Нажмите на кнопку "Открыть общую ссылку" ниже и скопируйте её
-2. Откройте приложение {app_name}
-3. Найдите раздел "Импорт" или "Добавить подписку"
-4. Вставьте скопированную ссылку
-5. Сохраните конфигурацию
-6. Включите VPN
-
-ℹ️ Если у вас возникнут проблемы:
-• Убедитесь, что ссылка скопирована полностью
-• Проверьте подключение к интернету
-• Попробуйте перезапустить приложение
-• При необходимости обратитесь к администраторам"""
-            markup.add(types.InlineKeyboardButton(text="🔗 Открыть общую ссылку", url=base_url))
-    
-    # Добавляем кнопки навигации
-    markup.add(types.InlineKeyboardButton(text="🔙 Назад к выбору приложений", callback_data=f"platform_{platform}"))
-    markup.add(types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="refresh_menu"))
-    
+    text, markup = screen.render(base_url, f"SubVPN_{call.from_user.id}")
     await bot.edit_message_text(
-        message_text,
+        text,
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         reply_markup=markup
     )
 
 @bot.callback_query_handler(func=lambda call: call.data == "refresh_menu")
+@timed(HANDLER_LATENCY, handler='handle_refresh_menu')
 async def handle_refresh_menu(call):
     """Обработчик обновления меню."""
     if call.message.chat.type != 'private':
@@ -386,14 +365,14 @@ async def handle_refresh_menu(call):
     welcome_message = f"👋 Привет, {user_link(call.from_user)}!\n\n"
     
     # Сбрасываем флаг режима поддержки
-    if call.from_user.id in bot.user_data:
-        bot.user_data[call.from_user.id]['in_support'] = False
+    if (await sessions.get(call.from_user.id)).get('in_support'):
+        await sessions.update(call.from_user.id, in_support=False)
     
     if tg_user:
         sub_link = await get_marzban_sub_url(tg_user_id, tg_user.user.full_name)
         
         # Сохраняем ссылку в сессии пользователя
-        bot.user_data[call.from_user.id] = {'sub_link': sub_link}
+        await sessions.set(call.from_user.id, {'sub_link': sub_link})
         
         welcome_message += """🎉 Добро пожаловать в VPN-бот SubVPN!
 
@@ -456,171 +435,486 @@ async def update_listener(messages):
     for message in messages:
         try:
             if (message.content_type == 'new_chat_members' or message.content_type == 'left_chat_member') and int(message.chat.id) == target_channel:
+                # Состав канала изменился, сбрасываем закешированные проверки
+                for member in message.new_chat_members or [message.left_chat_member]:
+                    membership_cache.pop(member.id)
+                    if message.new_chat_members:
+                        instant_renewals.submit(member.id)
                 await bot.delete_message(message.chat.id, message.message_id)
         except Exception as e:
             logger.error(f"Ошибка в update_listener: {e}")
 
 async def get_marzban_sub_url(tg_user_id, tg_user_full_name):
-    marzban_user = await check_user_marzban(tg_user_id)
-    if marzban_user:
-        return marzban_user.subscription_url
-    else:
-        marzban_new_user = await add_marzban_user(tg_user_id, tg_user_full_name)
-        return marzban_new_user.subscription_url
+    sub_url = sub_url_cache.get(tg_user_id)
+    if sub_url:
+        return sub_url
+    try:
+        marzban_user = await panel.get_or_create_user(
+            f"SUB_{tg_user_id}", lambda: new_marzban_user(tg_user_id, tg_user_full_name))
+    except Exception as e:
+        logger.error(f"Ошибка получения пользователя SUB_{tg_user_id} в Marzban: {e}")
+        raise
+    expiry_schedule.set(marzban_user.username, marzban_user.expire)
+    sub_url_cache.set(tg_user_id, marzban_user.subscription_url)
+    return marzban_user.subscription_url
+
+def cache_sub_url(marzban_user):
+    """Запоминает ссылку на подписку пользователя SUB_<tg_id> из ответа панели."""
+    try:
+        tg_user_id = int(marzban_user.username.replace("SUB_", ""))
+    except ValueError:
+        return
+    if marzban_user.subscription_url:
+        sub_url_cache.set(tg_user_id, marzban_user.subscription_url)
+
+@bot.chat_member_handler(func=lambda update: update.chat.id == target_channel)
+@timed(HANDLER_LATENCY, handler='handle_channel_member_update')
+async def handle_channel_member_update(update: types.ChatMemberUpdated):
+    """Обновляет кеш подписки при вступлении или выходе пользователя из канала."""
+    member = update.new_chat_member
+    membership_cache.set(member.user.id, member if member.status in MEMBER_STATUSES else False)
+    # Подписка изменилась, при следующей проверке пользователя нужно обработать заново
+    renewal_state.mark_stale(f"SUB_{member.user.id}")
+    logger.info(f"Статус пользователя {member.user.id} в канале изменился на {member.status}")
+    if member.status in MEMBER_STATUSES and update.old_chat_member.status not in MEMBER_STATUSES:
+        # Пользователь вернулся в канал: продлеваем подписку сразу, не дожидаясь проверки
+        instant_renewals.submit(member.user.id)
+
+async def fetch_channel_member(user_id):
+    """Участник канала или False, если пользователь не подписан. Ошибки Bot API пробрасываются."""
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
+    user = await bot.get_chat_member(chat_id=target_channel, user_id=user_id)
+    result = user if user.status in MEMBER_STATUSES else False
+    membership_cache.set(user_id, result)
+    return result
 
 async def check_user_in_channel(user_id):
     try:
-        user = await bot.get_chat_member(chat_id=target_channel, user_id=user_id)
-        if user.status in ['member', 'administrator', 'creator', 'restricted']:
-            return user
+        return await fetch_channel_member(user_id)
     except Exception as e:
         logger.error(f"Ошибка проверки пользователя в канале: {e}")
-    return False
+        return False
+
+def new_marzban_user(tg_id, tg_name):
+    """Описание нового пользователя панели с подпиской на 31 день."""
+    sub_date = datetime.datetime.today() + timedelta(days=31)
+    return UserCreate(username=f"SUB_{tg_id}",
+                      note=f"{tg_name}",
+                      proxies={
+                          "vless": ProxySettings(flow="xtls-rprx-vision")
+                      },
+                      expire=int(sub_date.timestamp()),
+                      status="active",
+                      inbounds={
+                          "vless": [
+                              "VLESS TCP REALITY"
+                          ]
+                      })
+
+def panel_user_lock(username):
+    lock = panel_user_locks.get(username)
+    if lock is None:
+        lock = panel_user_locks[username] = asyncio.Lock()
+    return lock
+
+async def remove_expired_user(item, tg_user_id):
+    """Удаляет давно просроченного пользователя, если он не вернулся в канал. Возвращает True при удалении."""
+    async with panel_user_lock(item.username):
+        # Пока шла проверка, пользователь мог вступить в канал и получить продление
+        try:
+            current = await panel.call('get_user', username=item.username)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            current = None
+        if current is not None:
+            if current.expire != item.expire or await check_user_in_channel(tg_user_id):
+                return False
+            await panel.call('remove_user', username=item.username)
+    sub_url_cache.pop(tg_user_id)
+    expiry_schedule.remove(item.username)
+    return True
+
+async def review_expired_user(item, tg_user_id, membership_limit, panel_limit):
+    """Проверяет подписку просроченного пользователя и удаляет давно просроченных.
+    
+    Возвращает 'renew', если пользователь состоит в канале и его подписку нужно продлить,
+    иначе итог обработки: 'removed' или 'skipped'.
+    """
+    async with membership_limit:
+        user = await check_user_in_channel(tg_user_id)
+    
+    if user:
+        return 'renew'
+    
+    if datetime.datetime.now() - datetime.datetime.fromtimestamp(item.expire) > timedelta(days=30):
+        async with panel_limit:
+            removed = await remove_expired_user(item, tg_user_id)
+        if removed:
+            logger.info(f"Удален просроченный пользователь: {item.username}")
+            return 'removed'
+    return 'skipped'
+
+async def renew_users(renewals, state_updates, stats):
+    """Продлевает подписки пользователей ``renewals`` (username -> (status, expire)) на 31 день.
+    
+    Панели передаются только новые срок действия и статус.
+    """
+    sub_date = datetime.datetime.today() + timedelta(days=31)
+    changes = {username: {'expire': int(sub_date.timestamp()), 'status': 'active'} for username in renewals}
+    results = await panel.modify_users(changes, concurrency=RENEWAL_PANEL_CONCURRENCY)
+    for username, result in results.items():
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка продления подписки пользователя {username}: {result}")
+            stats['failed'] += 1
+            continue
+        cache_sub_url(result)
+        expiry_schedule.set(result.username, result.expire)
+        stats['renewed'] += 1
+        status, expire = renewals[username]
+        state_updates.append((username, status, expire, True, time.time()))
+        update_logger.info(f"Продлена подписка пользователя: {username}")
+
+def record_review_outcome(item, outcome, renewals, stats, state_updates, removed_usernames):
+    """Раскладывает итог review_expired_user по продлениям, счетчикам и изменениям состояния."""
+    if outcome == 'renew':
+        renewals[item.username] = (item.status, item.expire)
+        return
+    stats[outcome] += 1
+    if outcome == 'removed':
+        removed_usernames.append(item.username)
+    else:
+        state_updates.append((item.username, item.status, item.expire, False, time.time()))
 
-async def check_user_marzban(tg_id):
+async def process_due_users(usernames):
+    """Обрабатывает пользователей, у которых истекла подписка или наступил порог удаления.
+    
+    Каждый пользователь запрашивается из панели: если его срок успел измениться,
+    он только переносится в расписании. Пользователи, уже обработанные проверкой
+    подписок, пропускаются так же, как в инкрементальном режиме проверки. Пока
+    выполняется проверка подписок, обработка ждет ее завершения, чтобы не
+    продлевать и не удалять одних и тех же пользователей параллельно с ней.
+    """
+    async with job_scheduler.jobs['renewal'].exclusive():
+        await _process_due_users(usernames)
+
+async def _process_due_users(usernames):
+    started_at = time.monotonic()
+    stats = Counter(renewed=0, removed=0, skipped=0, unchanged=0, failed=0)
+    membership_limit = asyncio.Semaphore(RENEWAL_CHECK_CONCURRENCY)
+    panel_limit = asyncio.Semaphore(RENEWAL_PANEL_CONCURRENCY)
+    state_updates = []
+    removed_usernames = []
+    renewals = {}
+    
+    async def process(username):
+        try:
+            async with panel_limit:
+                item = await panel.call('get_user', username=username)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                expiry_schedule.remove(username)
+                removed_usernames.append(username)
+                return
+            logger.error(f"Ошибка получения пользователя {username} из панели: {e}")
+            stats['failed'] += 1
+            return
+        except Exception as e:
+            logger.error(f"Ошибка получения пользователя {username} из панели: {e}")
+            stats['failed'] += 1
+            return
+        expiry_schedule.set(item.username, item.expire)
+        if item.expire is None or item.expire > time.time() or item.status not in ('active', 'expired'):
+            return
+        if RENEWAL_INCREMENTAL and not needs_check(item, renewal_state.get(username), RENEWAL_RECHECK_INTERVAL * 60,
+                                                   timedelta(days=30).total_seconds()):
+            stats['unchanged'] += 1
+            return
+        try:
+            tg_user_id = int(username.replace("SUB_", ""))
+        except ValueError:
+            stats['skipped'] += 1
+            return
+        try:
+            outcome = await review_expired_user(item, tg_user_id, membership_limit, panel_limit)
+            record_review_outcome(item, outcome, renewals, stats, state_updates, removed_usernames)
+        except Exception as e:
+            logger.error(f"Ошибка продления подписки пользователя {username}: {e}")
+            stats['failed'] += 1
+    
+    await asyncio.gather(*(process(username) for username in usernames))
+    if renewals:
+        await renew_users(renewals, state_updates, stats)
     try:
-        marzban_token = await api.get_token(username=panel_username, password=panel_pass)
-        user = await api.get_user(username=f"SUB_{tg_id}", token=marzban_token.access_token)
-        return user
+        renewal_state.save(state_updates)
+        renewal_state.delete(removed_usernames)
     except Exception as e:
-        logger.error(f"Ошибка проверки пользователя в Marzban: {e}")
-        return False
+        logger.error(f"Ошибка сохранения состояния проверки подписок: {e}")
+    
+    for outcome, count in stats.items():
+        RENEWAL_USERS.inc(count, outcome=outcome)
+    logger.info(
+        f"Наступили сроки подписки {len(usernames)} пользователей, обработано за "
+        f"{time.monotonic() - started_at:.1f} сек: продлено {stats['renewed']}, удалено {stats['removed']}, "
+        f"пропущено {stats['skipped']}, без изменений {stats['unchanged']}, ошибок {stats['failed']}"
+    )
 
-async def add_marzban_user(tg_id, tg_name):
+async def run_expiry_schedule():
+    """Загружает сроки подписки пользователей панели и обрабатывает их по мере наступления."""
     try:
-        marzban_token = await api.get_token(username=panel_username, password=panel_pass)
-        sub_date = datetime.datetime.today() + timedelta(days=31)
-        new_user = UserCreate(username=f"SUB_{tg_id}",
-                            note=f"{tg_name}",
-                            proxies={
-                                "vless": ProxySettings(flow="xtls-rprx-vision")                                                  
-                            },
-                            expire=int(sub_date.timestamp()),                                            
-                            status="active",
-                            inbounds={
-                                "vless": [
-                                    "VLESS TCP REALITY"
-                                ]
-                            })
-        user = await api.add_user(user=new_user, token=marzban_token.access_token)
-        logger.info(f"Создан новый пользователь: SUB_{tg_id}")
-        return user
+        expiry_schedule.load([(item.username, item.expire)
+                              async for item in panel.iter_users(page_size=PANEL_PAGE_SIZE, search="SUB_")
+                              if "SUB_" in item.username])
+        logger.info(f"[INIT] Загружены сроки подписки {len(expiry_schedule)} пользователей")
     except Exception as e:
-        logger.error(f"Ошибка создания пользователя: {e}")
-        return False
+        # Расписание дополнит проверка подписок, которая обходит всех пользователей панели
+        logger.error(f"Ошибка загрузки сроков подписки: {e}")
+    await expiry_schedule.run(process_due_users)
+
+async def renew_joined_user(tg_user_id):
+    """Продлевает просроченную подписку пользователя, вступившего в канал.
+    
+    Возвращает True, если подписка продлена, и False, если у пользователя нет
+    учетной записи в панели или она не просрочена.
+    """
+    username = f"SUB_{tg_user_id}"
+    # Проверка подписок не удалит пользователя, пока его подписка продлевается
+    async with panel_user_lock(username):
+        try:
+            item = await panel.call('get_user', username=username)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                # Учетная запись будет создана при первом обращении к боту
+                return False
+            raise
+        if item.status != 'expired':
+            return False
+        stats = Counter(renewed=0, failed=0)
+        state_updates = []
+        await renew_users({username: (item.status, item.expire)}, state_updates, stats)
+    renewal_state.save(state_updates)
+    if stats['failed']:
+        raise RuntimeError("панель не приняла продление")
+    logger.info(f"Подписка пользователя {username} продлена после вступления в канал")
+    return True
+
+# Продления по событиям вступления в канал; периодическая проверка подписок их подстраховывает
+instant_renewals = RenewalQueue(renew_joined_user, rate=INSTANT_RENEWAL_RATE, cooldown=INSTANT_RENEWAL_COOLDOWN)
 
 async def check_tg_and_recharge():
+    """Продлевает подписки участникам канала и удаляет давно просроченных пользователей.
+    
+    Пользователи проверяются параллельно с ограничением на число одновременных
+    проверок в Telegram и запросов к панели. Подписки продлеваются одним пакетом
+    после проверки всех пользователей. Ошибка одного пользователя не прерывает
+    проверку остальных. В инкрементальном режиме обрабатываются только впервые
+    просроченные пользователи, пользователи с устаревшей проверкой подписки и те,
+    кто пересек порог удаления. Возвращает счетчики renewed, removed, skipped,
+    unchanged и failed.
+    """
+    started_at = time.monotonic()
+    stats = Counter(renewed=0, removed=0, skipped=0, unchanged=0, failed=0)
+    membership_limit = asyncio.Semaphore(RENEWAL_CHECK_CONCURRENCY)
+    panel_limit = asyncio.Semaphore(RENEWAL_PANEL_CONCURRENCY)
+    # Ограничиваем число ожидающих обработки пользователей, чтобы не держать в памяти всю панель
+    backlog = asyncio.Semaphore(RENEWAL_CHECK_CONCURRENCY * 4)
+    tasks = set()
+    known_state = renewal_state.load()
+    seen_usernames = set()
+    state_updates = []
+    removed_usernames = []
+    renewals = {}
+    
+    async def process(item, tg_user_id):
+        try:
+            outcome = await review_expired_user(item, tg_user_id, membership_limit, panel_limit)
+            record_review_outcome(item, outcome, renewals, stats, state_updates, removed_usernames)
+        except Exception as e:
+            logger.error(f"Ошибка продления подписки пользователя {item.username}: {e}")
+            stats['failed'] += 1
+        finally:
+            backlog.release()
+    
+    scan_completed = False
     try:
-        marzban_token = await api.get_token(username=panel_username, password=panel_pass)
-        users = await api.get_users(token=marzban_token.access_token)
-        
-        for item in users.users:
-            if item.status == 'expired' and "SUB_" in item.username:
-                try:
-                    tg_user_id = int(item.username.replace("SUB_", ""))
-                except ValueError:
-                    # Пропускаем пользователей с нечисловыми ID
-                    continue
-                    
-                user = await check_user_in_channel(tg_user_id)
-                
-                if user:
-                    # Проверяем, истекла ли подписка
-                        sub_date = datetime.datetime.today() + timedelta(days=31)
-                        await api.modify_user(username=f"SUB_{tg_user_id}",
-                                            user=UserModify(
-                                                username=f"SUB_{tg_user_id}",
-                                                note=f"{user.user.full_name}",
-                                                proxies=item.proxies,
-                                                data_limit=0,
-                                                expire=int(sub_date.timestamp()),
-                                                data_limit_reset_strategy="no_reset",
-                                                status="active",
-                                                inbounds={
-                                                    "vless": [
-                                                        "VLESS TCP REALITY"
-                                                    ]
-                                                }), token=marzban_token.access_token)
-                        logger.info(f"Продлена подписка пользователя: SUB_{tg_user_id}")
-                else:
-                    if datetime.datetime.now() - datetime.datetime.fromtimestamp(item.expire) > timedelta(days=30):
-                        await api.remove_user(username=item.username, token=marzban_token.access_token)
-                        logger.info(f"Удален просроченный пользователь: {item.username}")
+        # Читаем панель с конца, чтобы продление и удаление не сдвигали непрочитанные страницы
+        async for item in panel.iter_users(page_size=PANEL_PAGE_SIZE, reverse=True, search="SUB_"):
+            if "SUB_" not in item.username:
+                continue
+            seen_usernames.add(item.username)
+            cache_sub_url(item)
+            expiry_schedule.set(item.username, item.expire)
+            state = known_state.get(item.username)
+            if item.status != 'expired':
+                if state is None or state['status'] != item.status or state['expire'] != item.expire:
+                    state_updates.append((item.username, item.status, item.expire, None, 0))
+                continue
+            if RENEWAL_INCREMENTAL and not needs_check(item, state, RENEWAL_RECHECK_INTERVAL * 60,
+                                                       timedelta(days=30).total_seconds()):
+                stats['unchanged'] += 1
+                continue
+            try:
+                tg_user_id = int(item.username.replace("SUB_", ""))
+            except ValueError:
+                # Пропускаем пользователей с нечисловыми ID
+                stats['skipped'] += 1
+                continue
+            await backlog.acquire()
+            task = asyncio.create_task(process(item, tg_user_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        scan_completed = True
     except Exception as e:
         logger.error(f"Ошибка проверки и продления подписок: {e}")
+    await asyncio.gather(*tasks)
+    
+    if renewals:
+        await renew_users(renewals, state_updates, stats)
+    
+    try:
+        if scan_completed:
+            # Забываем пользователей, которых больше нет в панели
+            removed_usernames.extend(set(known_state) - seen_usernames)
+            expiry_schedule.retain(seen_usernames)
+        renewal_state.save(state_updates)
+        renewal_state.delete(removed_usernames)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения состояния проверки подписок: {e}")
+    
+    RENEWAL_DURATION.observe(time.monotonic() - started_at)
+    for outcome, count in stats.items():
+        RENEWAL_USERS.inc(count, outcome=outcome)
+    logger.info(
+        f"Проверка подписок завершена за {time.monotonic() - started_at:.1f} сек: "
+        f"продлено {stats['renewed']}, удалено {stats['removed']}, "
+        f"пропущено {stats['skipped']}, без изменений {stats['unchanged']}, ошибок {stats['failed']}"
+    )
+    return stats
+
+def format_broadcast_progress(current_count, total_users, success_count, fail_count, skip_count=0):
+    """Формирует текст прогресс-бара рассылки."""
+    progress = (current_count / total_users) * 100 if total_users else 100
+    progress_bar = "█" * int(progress / 2) + "░" * (50 - int(progress / 2))
+    status_text = f"📤 Рассылка в процессе...\n\n{progress_bar} {progress:.1f}%\n\n"
+    status_text += f"✅ Успешно: {success_count}\n"
+    status_text += f"❌ Неудачно: {fail_count}\n"
+    if skip_count:
+        status_text += f"⏭ Не подписаны на канал: {skip_count}\n"
+    status_text += f"📊 Всего: {current_count}/{total_users}"
+    return status_text
 
 async def send_message_to_all_users(message_text: str, progress_message=None):
     """Отправляет сообщение всем активным пользователям бота."""
     try:
-        marzban_token = await api.get_token(username=panel_username, password=panel_pass)
-        users = await api.get_users(token=marzban_token.access_token)
-        
+        recipients = []
+        skipped_count = 0
         # Фильтруем только активных пользователей
-        active_users = [user for user in users.users if user.status == 'active' and "SUB_" in user.username]
-        total_users = len(active_users)
-        
-        success_count = 0
-        fail_count = 0
-        current_count = 0
-        
-        for user in active_users:
+        async for user in panel.iter_users(page_size=PANEL_PAGE_SIZE, status='active', search="SUB_"):
+            if user.status != 'active' or "SUB_" not in user.username:
+                continue
             try:
                 # Пробуем получить числовой ID из username
-                tg_user_id = int(user.username.replace("SUB_", ""))
+                recipients.append(int(user.username.replace("SUB_", "")))
             except ValueError:
                 logger.warning(f"Пропущен пользователь с некорректным ID: {user.username}")
-                fail_count += 1
-                current_count += 1
-                continue
-            
-            # Проверяем, является ли пользователь подписчиком канала
-            if not await check_user_in_channel(tg_user_id):
-                logger.warning(f"Пропущен пользователь {tg_user_id}: не является подписчиком канала")
-                fail_count += 1
-                current_count += 1
-                continue
-                
-            try:
-                await bot.send_message(
-                    chat_id=tg_user_id,
-                    text=message_text,
-                    parse_mode='HTML'
-                )
-                logger.info(f"[BROADCAST] Сообщение отправлено пользователю {tg_user_id}")
-                success_count += 1
-                # Добавляем задержку между отправками
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                logger.error(f"[BROADCAST] Ошибка отправки сообщения пользователю {tg_user_id}: {e}")
-                fail_count += 1
-            
-            current_count += 1
-            
-            # Обновляем прогресс-бар каждые 5 сообщений или если это последнее сообщение
-            if progress_message and (current_count % 5 == 0 or current_count == total_users):
-                progress = (current_count / total_users) * 100
-                progress_bar = "█" * int(progress / 2) + "░" * (50 - int(progress / 2))
-                status_text = f"📤 Рассылка в процессе...\n\n{progress_bar} {progress:.1f}%\n\n"
-                status_text += f"✅ Успешно: {success_count}\n"
-                status_text += f"❌ Неудачно: {fail_count}\n"
-                status_text += f"📊 Всего: {current_count}/{total_users}"
-                
-                try:
-                    await bot.edit_message_text(
-                        status_text,
-                        chat_id=progress_message.chat.id,
-                        message_id=progress_message.message_id
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка обновления прогресс-бара: {e}")
-                    
-        logger.info(f"[BROADCAST] Рассылка завершена. Успешно: {success_count}, Неудачно: {fail_count}")
-        return success_count, fail_count
+                skipped_count += 1
+        
+        # Сохраняем задание, чтобы продолжить его после перезапуска бота
+        job_id = broadcast_store.create_job(
+            message_text,
+            recipients,
+            chat_id=progress_message.chat.id if progress_message else None,
+            progress_message_id=progress_message.message_id if progress_message else None,
+            skipped=skipped_count
+        )
+        logger.info(f"[BROADCAST] Создано задание рассылки #{job_id} на {len(recipients)} получателей")
+        return await run_broadcast_job(job_id)
     except Exception as e:
         logger.error(f"[BROADCAST] Ошибка при рассылке: {e}")
-        return 0, 0
+        return 0, 0, 0
+
+async def run_broadcast_job(job_id: int):
+    """Выполняет задание рассылки по получателям, которые еще не получили сообщение."""
+    job = broadcast_store.get_job(job_id)
+    skipped_count = job['skipped']
+    sent_before, failed_before, skipped_before, _ = broadcast_store.counts(job_id)
+    
+    async def deliver(tg_user_id):
+        # Проверяем, является ли пользователь подписчиком канала. Ошибки Bot API доходят
+        # до движка рассылки, чтобы ответ 429 приостановил рассылку, а сбои повторились
+        if not await fetch_channel_member(tg_user_id):
+            update_logger.warning(f"Пропущен пользователь {tg_user_id}: не является подписчиком канала")
+            return False
+        await bot.send_message(
+            chat_id=tg_user_id,
+            text=job['text'],
+            parse_mode='HTML'
+        )
+        update_logger.info(f"[BROADCAST] Сообщение отправлено пользователю {tg_user_id}")
+        return True
+    
+    async def update_progress(done, success_count, fail_count, skip_count, total):
+        await bot.edit_message_text(
+            format_broadcast_progress(done + skipped_count, total + skipped_count,
+                                      success_count, fail_count + skipped_count, skip_count),
+            chat_id=job['chat_id'],
+            message_id=job['progress_message_id']
+        )
+    
+    active_broadcasts.add(job_id)
+    try:
+        engine = BroadcastEngine(
+            deliver,
+            workers=BROADCAST_WORKERS,
+            rate=BROADCAST_RATE,
+            on_progress=update_progress if job['progress_message_id'] else None,
+            on_result=lambda tg_user_id, status: broadcast_store.record(job_id, tg_user_id, status),
+            initial_counts=(sent_before, failed_before, skipped_before)
+        )
+        try:
+            success_count, fail_count, skip_count = await engine.run(broadcast_store.pending_recipients(job_id))
+        finally:
+            # Дописываем итоги доставок, накопленные с последнего пакета
+            await broadcast_store.flush()
+        broadcast_store.finish_job(job_id)
+    finally:
+        active_broadcasts.discard(job_id)
+    fail_count += skipped_count
+    
+    logger.info(f"[BROADCAST] Рассылка #{job_id} завершена. Успешно: {success_count}, Неудачно: {fail_count}, "
+                f"не подписаны на канал: {skip_count}")
+    return success_count, fail_count, skip_count
+
+async def resume_broadcast_job(job_id: int):
+    """Продолжает прерванное задание рассылки и отправляет итоговый отчет администратору."""
+    job = broadcast_store.get_job(job_id)
+    logger.info(f"[BROADCAST] Возобновляю задание рассылки #{job_id}")
+    try:
+        success_count, fail_count, skip_count = await run_broadcast_job(job_id)
+        if job['chat_id'] and job['progress_message_id']:
+            await bot.edit_message_text(
+                format_broadcast_report(job['text'], success_count, fail_count, skip_count),
+                chat_id=job['chat_id'],
+                message_id=job['progress_message_id']
+            )
+    except Exception as e:
+        logger.error(f"[BROADCAST] Ошибка при возобновлении рассылки #{job_id}: {e}")
+
+def format_broadcast_report(broadcast_text, success_count, fail_count, skip_count=0):
+    """Формирует итоговый отчет о рассылке."""
+    return (
+        f"✅ Рассылка завершена!\n\n"
+        f"📊 Статистика:\n"
+        f"✅ Успешно отправлено: {success_count}\n"
+        f"❌ Не удалось отправить: {fail_count}\n"
+        f"⏭ Не подписаны на канал: {skip_count}\n"
+        f"📝 Текст сообщения:\n{broadcast_text}"
+    )
 
 @bot.message_handler(commands=['broadcast'], content_types=['text'])
+@timed(HANDLER_LATENCY, handler='broadcast')
 async def broadcast(message: types.Message):
     """Рассылка сообщения всем пользователям."""
     logger.info("="*50)
@@ -650,26 +944,24 @@ async def broadcast(message: types.Message):
         return
 
     logger.info(f"[BROADCAST] Начинаю рассылку текста: {broadcast_text}")
+    # Рассылка идет в фоне, чтобы не занимать обработку обновлений администратора
+    asyncio.create_task(run_broadcast_command(message, broadcast_text))
+    logger.info("="*50)
 
+async def run_broadcast_command(message: types.Message, broadcast_text: str):
+    """Выполняет рассылку по команде /broadcast и присылает администратору отчет."""
     try:
         # Создаем прогресс-бар
         progress_message = await bot.reply_to(message, "📤 Подготовка к рассылке...")
         logger.info("[BROADCAST] Создан прогресс-бар")
         
         # Отправляем сообщение всем пользователям
-        success_count, fail_count = await send_message_to_all_users(f"{broadcast_text}", progress_message)
+        success_count, fail_count, skip_count = await send_message_to_all_users(f"{broadcast_text}", progress_message)
         logger.info(f"[BROADCAST] Рассылка завершена. Успешно: {success_count}, Неудачно: {fail_count}")
         
         # Отправляем итоговый отчет
-        final_report = (
-            f"✅ Рассылка завершена!\n\n"
-            f"📊 Статистика:\n"
-            f"✅ Успешно отправлено: {success_count}\n"
-            f"❌ Не удалось отправить: {fail_count}\n"
-            f"📝 Текст сообщения:\n{broadcast_text}"
-        )
         await bot.edit_message_text(
-            final_report,
+            format_broadcast_report(broadcast_text, success_count, fail_count, skip_count),
             chat_id=message.chat.id,
             message_id=progress_message.message_id
         )
@@ -678,32 +970,167 @@ async def broadcast(message: types.Message):
     except Exception as e:
         logger.error(f"[BROADCAST] Ошибка при выполнении рассылки: {e}")
         await bot.reply_to(message, f"❌ Произошла ошибка при выполнении рассылки: {str(e)}")
+
+@bot.message_handler(commands=['broadcast_resume'], content_types=['text'])
+@timed(HANDLER_LATENCY, handler='broadcast_resume')
+async def broadcast_resume(message: types.Message):
+    """Продолжение прерванной рассылки: без аргументов выводит список незавершенных заданий."""
+    if message.chat.type != 'private' or message.from_user.id not in admin_ids:
+        return
     
-    logger.info("="*50)
+    args = message.text.split()[1:]
+    if not args:
+        jobs = broadcast_store.unfinished_jobs()
+        if not jobs:
+            await bot.reply_to(message, "✅ Незавершенных рассылок нет.")
+            return
+        lines = ["📋 Незавершенные рассылки:\n"]
+        for job in jobs:
+            sent, failed, skipped, pending = broadcast_store.counts(job['id'])
+            status = "выполняется" if job['id'] in active_broadcasts else "остановлена"
+            lines.append(f"#{job['id']} ({status}): отправлено {sent}, ошибок {failed}, "
+                         f"не подписаны {skipped}, осталось {pending}")
+        lines.append("\nДля продолжения: /broadcast_resume <номер>")
+        await bot.reply_to(message, "\n".join(lines))
+        return
+    
+    try:
+        job_id = int(args[0].lstrip('#'))
+    except ValueError:
+        await bot.reply_to(message, "❌ Укажите номер задания рассылки, например: /broadcast_resume 3")
+        return
+    job = broadcast_store.get_job(job_id)
+    if not job or job['status'] != 'running':
+        await bot.reply_to(message, f"❌ Незавершенная рассылка #{job_id} не найдена.")
+        return
+    if job_id in active_broadcasts:
+        await bot.reply_to(message, f"⏳ Рассылка #{job_id} уже выполняется.")
+        return
+    
+    await bot.reply_to(message, f"📤 Продолжаю рассылку #{job_id}...")
+    asyncio.create_task(resume_broadcast_job(job_id))
+
+# Периодические задачи бота
+job_scheduler = JobScheduler()
+job_scheduler.add('renewal', check_tg_and_recharge, datetime.timedelta(minutes=check_cooldown),
+                  first_delay=datetime.timedelta(seconds=10), timeout=RENEWAL_TIMEOUT or None, jitter=JOB_JITTER)
+
+def format_job_status(job, next_run):
+    """Формирует строку состояния периодической задачи для администратора."""
+    lines = [f"⚙️ {job.name}"]
+    if job.running_since is not None:
+        lines.append(f"Выполняется с {datetime.datetime.fromtimestamp(job.running_since):%d.%m %H:%M:%S}")
+    elif job.waiting_since is not None:
+        lines.append(f"Ожидает запуска с {datetime.datetime.fromtimestamp(job.waiting_since):%d.%m %H:%M:%S}")
+    if job.last_started_at is not None:
+        lines.append(f"Последний запуск: {datetime.datetime.fromtimestamp(job.last_started_at):%d.%m %H:%M:%S}, "
+                     f"{job.last_duration:.1f} сек, итог: {job.last_outcome}")
+        if job.last_error:
+            lines.append(f"Ошибка: {job.last_error}")
+    else:
+        lines.append("Еще не запускалась")
+    if next_run is not None:
+        lines.append(f"Следующий запуск: {next_run:%d.%m %H:%M:%S}")
+    if job.outcomes:
+        lines.append("Запусков: " + ", ".join(f"{outcome} {count}" for outcome, count in sorted(job.outcomes.items())))
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['jobs'])
+@timed(HANDLER_LATENCY, handler='jobs_status')
+async def jobs_status(message: types.Message):
+    """Состояние периодических задач для администраторов."""
+    if message.chat.type != 'private' or message.from_user.id not in admin_ids:
+        return
+    statuses = [format_job_status(job, job_scheduler.next_run(name)) for name, job in job_scheduler.jobs.items()]
+    await bot.reply_to(message, "\n\n".join(statuses))
+
+# Типы сообщений, у которых можно заменить подпись при копировании
+CAPTION_CONTENT_TYPES = ('photo', 'video', 'document', 'voice', 'audio', 'animation')
+# Максимальная длина подписи к медиафайлу в Telegram
+CAPTION_MAX_LENGTH = 1024
+SUPPORT_REPLY_HEADER = "💬 Ответ от поддержки:"
+
+def support_reply_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("💬 Есть еще вопросы", callback_data="support"))
+    markup.add(types.InlineKeyboardButton("🏠 В главное меню", callback_data="refresh_menu"))
+    return markup
+
+def support_reply_caption(message: types.Message):
+    """Подпись с заголовком ответа поддержки и сдвинутым форматированием исходной подписи."""
+    prefix = f"{SUPPORT_REPLY_HEADER}\n\n" if message.caption else SUPPORT_REPLY_HEADER
+    caption = prefix + (message.caption or "")
+    if len(caption) > CAPTION_MAX_LENGTH:
+        return None, None
+    # Смещения форматирования в Telegram считаются в UTF-16
+    shift = len(prefix.encode('utf-16-le')) // 2
+    # MessageEntity.to_dict оставляет user объектом User, который не сериализуется в JSON
+    entities = []
+    for entity in message.caption_entities or []:
+        fields = {**entity.to_dict(), 'offset': entity.offset + shift}
+        if entity.user:
+            fields['user'] = {key: value for key, value in entity.user.to_dict().items() if value is not None}
+        entities.append({key: value for key, value in fields.items() if value is not None})
+    return caption, entities or None
+
+async def send_support_reply(message: types.Message, user_id: int):
+    """Отправляет ответ поддержки пользователю одним запросом к Bot API."""
+    markup = support_reply_markup()
+    if message.content_type == 'text':
+        await bot.send_message(
+            chat_id=user_id,
+            text=f"{SUPPORT_REPLY_HEADER}\n\n{message.text}\n\nЕсли у вас остались вопросы, нажмите кнопку ниже.",
+            reply_markup=markup
+        )
+        return
+    
+    caption = caption_entities = None
+    if message.content_type in CAPTION_CONTENT_TYPES:
+        caption, caption_entities = support_reply_caption(message)
+    # Медиафайл копируется вместе с заголовком в подписи и кнопками навигации
+    await bot.copy_message(
+        chat_id=user_id,
+        from_chat_id=message.chat.id,
+        message_id=message.message_id,
+        caption=caption,
+        caption_entities=caption_entities,
+        reply_markup=markup
+    )
+
+def support_reply_recipient(message: types.Message):
+    """Находит пользователя, которому адресован ответ в чате поддержки."""
+    reply_to = message.reply_to_message
+    user_id = support_relay.lookup(message.chat.id, reply_to.message_id)
+    if user_id is None and isinstance(reply_to.forward_origin, types.MessageOriginUser):
+        # Сообщения, пересланные до появления индекса, с открытым автором
+        user_id = reply_to.forward_origin.sender_user.id
+    return user_id
 
 @bot.message_handler(content_types=['text', 'photo', 'video', 'document', 'sticker', 'voice', 'video_note'])
+@timed(HANDLER_LATENCY, handler='handle_messages')
 async def handle_messages(message: types.Message):
     """Единый обработчик сообщений для поддержки."""
-    logger.info("="*50)
-    logger.info(f"Обработка сообщения: тип={message.content_type}, чат={message.chat.id}")
+    update_logger.info("="*50)
+    update_logger.info(f"Обработка сообщения: тип={message.content_type}, чат={message.chat.id}")
 
     # Определяем тип сообщения и направление
     is_from_support = str(message.chat.id) == str(SUPPORT_CHAT_ID)
-    is_reply_to_forwarded = message.reply_to_message and message.reply_to_message.forward_from
+    is_reply = message.reply_to_message is not None
     is_private_chat = message.chat.type == 'private'
-    is_in_support_mode = message.from_user.id in bot.user_data and bot.user_data[message.from_user.id].get('in_support')
+    is_in_support_mode = (await sessions.get(message.from_user.id)).get('in_support')
 
     try:
         # Обработка сообщений от пользователей в поддержку
         if is_private_chat and is_in_support_mode and not is_from_support:
-            logger.info(f"Пересылка сообщения от пользователя {message.from_user.id} в поддержку")
+            update_logger.info(f"Пересылка сообщения от пользователя {message.from_user.id} в поддержку")
             
-            # Пересылаем сообщение
-            await bot.forward_message(
+            # Пересылаем сообщение и запоминаем его автора для ответа
+            forwarded = await bot.forward_message(
                 chat_id=SUPPORT_CHAT_ID,
                 from_chat_id=message.chat.id,
                 message_id=message.message_id
             )
+            support_relay.record(forwarded.chat.id, forwarded.message_id, message.from_user.id)
             
             await bot.reply_to(
                 message,
@@ -711,72 +1138,29 @@ async def handle_messages(message: types.Message):
             )
             
         # Обработка ответов от поддержки пользователям
-        elif is_from_support and is_reply_to_forwarded:
-            logger.info(f"Отправка ответа от поддержки пользователю {message.reply_to_message.forward_from.id}")
-            user_id = message.reply_to_message.forward_from.id
-            
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("💬 Есть еще вопросы", callback_data="support"))
-            markup.add(types.InlineKeyboardButton("🏠 В главное меню", callback_data="refresh_menu"))
-            
-            # Отправляем ответ пользователю
-            if message.content_type == 'text':
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=f"💬 Ответ от поддержки:\n\n{message.text}\n\nЕсли у вас остались вопросы, нажмите кнопку ниже.",
-                    reply_markup=markup
-                )
+        elif is_from_support and is_reply:
+            user_id = support_reply_recipient(message)
+            if user_id is None:
+                if message.reply_to_message.forward_origin is not None:
+                    await bot.reply_to(message, "❌ Не удалось определить пользователя, которому адресован ответ.")
             else:
+                update_logger.info(f"Отправка ответа от поддержки пользователю {user_id}")
                 try:
-                    # Сначала отправляем текст о том, что это ответ от поддержки
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="💬 Ответ от поддержки:"
-                    )
-                    
-                    # Для медиафайлов используем copy_message
-                    await bot.copy_message(
-                        chat_id=user_id,
-                        from_chat_id=message.chat.id,
-                        message_id=message.message_id
-                    )
-                    
-                    # Отправляем кнопки навигации
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="Если у вас остались вопросы, нажмите кнопку ниже.",
-                        reply_markup=markup
-                    )
+                    await send_support_reply(message, user_id)
                 except Exception as e:
-                    logger.error(f"Ошибка при копировании медиафайла: {e}")
-                    # Пробуем альтернативный способ отправки
-                    try:
-                        if message.photo:
-                            await bot.send_photo(user_id, message.photo[-1].file_id, caption=message.caption)
-                        elif message.video:
-                            await bot.send_video(user_id, message.video.file_id, caption=message.caption)
-                        elif message.document:
-                            await bot.send_document(user_id, message.document.file_id)
-                        elif message.sticker:
-                            await bot.send_sticker(user_id, message.sticker.file_id)
-                        elif message.voice:
-                            await bot.send_voice(user_id, message.voice.file_id)
-                        elif message.video_note:
-                            await bot.send_video_note(user_id, message.video_note.file_id)
-                    except Exception as e2:
-                        logger.error(f"Ошибка при альтернативной отправке медиафайла: {e2}")
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text="❌ К сожалению, произошла ошибка при отправке медиафайла. Пожалуйста, попробуйте позже.",
-                            reply_markup=markup
-                        )
+                    logger.error(f"Ошибка отправки ответа поддержки пользователю {user_id}: {e}")
+                    # Сообщаем поддержке, чтобы ответ не потерялся незаметно
+                    await bot.reply_to(message, f"❌ Ответ не доставлен пользователю {user_id}: {e}")
             
     except Exception as e:
         logger.error(f"Ошибка обработки сообщения: {e}")
         
-    logger.info("="*50)
+    update_logger.info("="*50)
 
 async def main():
+    # Открываем соединение с панелью и получаем токен заранее
+    await panel.start()
+    
     # Регистрируем команды бота
     commands = [
         types.BotCommand(command='start', description='Запустить бота')
@@ -785,27 +1169,126 @@ async def main():
     
     chat = await bot.get_chat(target_channel)
     bot.set_update_listener(update_listener)
+    
+    # Продолжаем рассылки, прерванные перезапуском бота
+    for job in broadcast_store.unfinished_jobs():
+        asyncio.create_task(resume_broadcast_job(job['id']))
     logger.info(f"[INIT]BOT STARTED for {chat.title}")
     telebot.apihelper.RETRY_ON_ERROR = True
-    await asyncio.gather(bot.infinity_polling(
-        allowed_updates=['message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query',
-                         'chosen_inline_result', 'callback_query', 'shipping_query', 'pre_checkout_query', 'poll',
-                         'poll_answer', 'my_chat_member', 'chat_member', 'chat_join_request', 'message_reaction',
-                         'message_reaction_count', 'chat_boost', 'removed_chat_boost', 'business_connection',
-                         'business_message', 'edited_business_message', 'deleted_business_messages']), schedule_task())
-
-
-async def schedule_task():
-    loop = asyncio.get_running_loop()
-    schedule = Scheduler(loop=loop)
-    schedule.once(datetime.timedelta(seconds=10), check_tg_and_recharge)
-    schedule.cyclic(datetime.timedelta(minutes=check_cooldown), check_tg_and_recharge)
-
+    if METRICS_PORT:
+        await start_metrics_server()
+    allowed_updates = collect_allowed_updates()
+    logger.info(f"[INIT] Запрашиваемые типы обновлений: {', '.join(allowed_updates)}")
+    # supervisord останавливает бота сигналом SIGTERM: отменяем main, чтобы корректно завершить задачи
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    job_scheduler.start()
+    instant_renewals.start()
+    expiry_task = asyncio.create_task(run_expiry_schedule())
+    try:
+        if UPDATE_MODE == 'webhook':
+            await run_webhook(allowed_updates)
+        else:
+            # Telegram не отдает обновления через getUpdates, пока установлен webhook
+            await bot.remove_webhook()
+            await bot.infinity_polling(allowed_updates=allowed_updates)
+    except asyncio.CancelledError:
+        logger.info("[STOP] Получен сигнал остановки, завершаю работу")
+    finally:
+        expiry_task.cancel()
+        await instant_renewals.close()
+        await job_scheduler.shutdown(grace=JOB_SHUTDOWN_GRACE)
+        await panel.close()
+
+
+async def start_metrics_server():
+    """Запускает HTTP-сервер, отдающий метрики в формате Prometheus на /metrics."""
+    async def handle_metrics(request):
+        return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+    
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"[INIT] Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+def collect_allowed_updates():
+    """Собирает типы обновлений, для которых у бота зарегистрированы обработчики."""
+    allowed_updates = [update_type for handlers, update_type in HANDLER_UPDATE_TYPES.items()
+                       if getattr(bot, handlers, None)]
+    # update_listener получает только сообщения
+    if bot.update_listener and 'message' not in allowed_updates:
+        allowed_updates.append('message')
+    for update_type in EXTRA_ALLOWED_UPDATES:
+        if update_type not in allowed_updates:
+            allowed_updates.append(update_type)
+    return allowed_updates
+
+
+async def consume_updates(updates: asyncio.Queue):
+    """Разбирает очередь обновлений, полученных через webhook, и передает их обработчикам бота.
+    
+    Каждое обновление обрабатывается в отдельной задаче, очередность и параллелизм
+    ограничивает UpdateGate. В обработке одновременно находится не более
+    WEBHOOK_QUEUE_SIZE обновлений, остальные ждут в очереди webhook.
+    """
+    pending = asyncio.Semaphore(WEBHOOK_QUEUE_SIZE)
+    tasks = set()
+    
+    async def process(update):
+        try:
+            await bot.process_new_updates([types.Update.de_json(update)])
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления из webhook: {e}")
+        finally:
+            pending.release()
+            updates.task_done()
+    
     while True:
-        await asyncio.sleep(2)
+        update = await updates.get()
+        await pending.acquire()
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+async def run_webhook(allowed_updates):
+    """Принимает обновления через webhook на FastAPI-приложении прокси-сервера."""
+    updates = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    REGISTRY.gauge('subvpn_webhook_queue_depth', 'Обновления из webhook, ожидающие обработки', updates.qsize)
+    add_telegram_webhook(web_app, WEBHOOK_SECRET, updates)
+    
+    ssl_keyfile, ssl_certfile = find_ssl_files()
+    if not os.path.exists(ssl_certfile):
+        # Без сертификатов слушаем HTTP, например за обратным прокси или при локальной проверке
+        logger.warning("[WEBHOOK] Сертификаты не найдены, webhook принимается по HTTP")
+        ssl_keyfile = ssl_certfile = None
+    server = uvicorn.Server(uvicorn.Config(
+        web_app,
+        host="0.0.0.0",
+        port=WEBHOOK_PORT,
+        ssl_keyfile=ssl_keyfile,
+        ssl_certfile=ssl_certfile,
+        log_level=LOG_LEVEL.lower()
+    ))
+    
+    consumer = asyncio.create_task(consume_updates(updates))
+    await bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates,
+        max_connections=WEBHOOK_WORKERS
+    )
+    logger.info(f"[WEBHOOK] Прием обновлений на порту {WEBHOOK_PORT}")
+    try:
+        await server.serve()
+    finally:
+        consumer.cancel()
 
 
 @bot.message_handler(commands=['support'])
+@timed(HANDLER_LATENCY, handler='cmd_support')
 async def cmd_support(message: types.Message):
     """Обработчик команды для обращения в поддержку."""
     if message.chat.type != 'private':
@@ -833,6 +1316,7 @@ async def cmd_support(message: types.Message):
 
 # Добавляем обработчик для кнопки поддержки
 @bot.callback_query_handler(func=lambda call: call.data == "support")
+@timed(HANDLER_LATENCY, handler='handle_support_button')
 async def handle_support_button(call):
     """Обработчик нажатия кнопки поддержки."""
     if call.message.chat.type != 'private':
@@ -848,9 +1332,7 @@ async def handle_support_button(call):
         await bot.answer_callback_query(call.id)
         
         # Устанавливаем флаг, что пользователь находится в режиме поддержки
-        if call.from_user.id not in bot.user_data:
-            bot.user_data[call.from_user.id] = {}
-        bot.user_data[call.from_user.id]['in_support'] = True
+        await sessions.update(call.from_user.id, in_support=True)
         
         # Создаем клавиатуру с кнопкой возврата в главное меню
         markup = types.InlineKeyboardMarkup()
@@ -873,14 +1355,16 @@ async def handle_support_button(call):
 
 # Добавляем обработчик для всех сообщений для отладки
 @bot.message_handler(func=lambda message: True)
+@timed(HANDLER_LATENCY, handler='debug_all_messages')
 async def debug_all_messages(message: types.Message):
     """Отладочный обработчик для всех сообщений."""
-    logger.info("="*50)
-    logger.info(f"[DEBUG] Получено сообщение: {message.text}")
-    logger.info(f"[DEBUG] От пользователя: {message.from_user.id}")
-    logger.info(f"[DEBUG] Тип чата: {message.chat.type}")
-    logger.info(f"[DEBUG] Тип контента: {message.content_type}")
-    logger.info(f"[DEBUG] Команды: {message.entities}")
-    logger.info("="*50)
-
-asyncio.run(main())
+    update_logger.info("="*50)
+    update_logger.info(f"[DEBUG] Получено сообщение: {message.text}")
+    update_logger.info(f"[DEBUG] От пользователя: {message.from_user.id}")
+    update_logger.info(f"[DEBUG] Тип чата: {message.chat.type}")
+    update_logger.info(f"[DEBUG] Тип контента: {message.content_type}")
+    update_logger.info(f"[DEBUG] Команды: {message.entities}")
+    update_logger.info("="*50)
+
+if __name__ == "__main__":
+    asyncio.run(main())
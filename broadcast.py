@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+import aiohttp
+from telebot.asyncio_helper import ApiTelegramException, RequestTimeout
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('subvpn.broadcast')
+
+BROADCAST_MESSAGES = REGISTRY.counter('subvpn_broadcast_messages_total', 'Получатели, обработанные рассылкой')
+
+# Ошибки сети и таймауты, после которых имеет смысл повторить отправку
+TRANSIENT_ERRORS = (RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class TokenBucket:
+    """Ограничитель частоты: не более ``rate`` операций в секунду с запасом ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """Рассылка сообщений пулом воркеров с учетом лимитов Bot API.
+
+    ``deliver(chat_id)`` отправляет сообщение одному получателю и возвращает
+    True при успехе или False, если получатель пропущен; пропущенные считаются
+    отдельно от неудачных доставок. Ответ 429 приостанавливает
+    всех воркеров на ``retry_after`` секунд, сетевые ошибки и ошибки 5xx
+    повторяются с экспоненциальной задержкой, остальные ошибки считаются неудачей.
+    """
+
+    def __init__(self, deliver: Callable[[int], Awaitable[bool]], *,
+                 workers: int = 20, rate: float = 25, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, backoff: float = 1.0,
+                 on_progress: Optional[Callable[[int, int, int, int, int], Awaitable]] = None,
+                 progress_interval: float = 3.0,
+                 on_result: Optional[Callable[[int, str], None]] = None,
+                 initial_counts: tuple = (0, 0, 0)):
+        self._deliver = deliver
+        self._on_result = on_result
+        self._workers = workers
+        self._bucket = TokenBucket(rate)
+        self._per_chat_interval = per_chat_interval
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._on_progress = on_progress
+        self._progress_interval = progress_interval
+        self._paused_until = 0.0
+        self.total = 0
+        # При возобновлении задания счетчики продолжают уже накопленные значения
+        self.success_count, self.fail_count, self.skip_count = initial_counts
+
+    @property
+    def done_count(self) -> int:
+        return self.success_count + self.fail_count + self.skip_count
+
+    async def _wait_for_pause(self):
+        delay = self._paused_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._paused_until - time.monotonic()
+
+    async def _send_with_retries(self, chat_id: int) -> bool:
+        attempt = 0
+        while True:
+            await self._wait_for_pause()
+            await self._bucket.acquire()
+            # Повторная отправка в тот же чат не чаще лимита на чат
+            delay = max(self._backoff * 2 ** attempt, self._per_chat_interval)
+            try:
+                return await self._deliver(chat_id)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning(f"[BROADCAST] Превышен лимит Bot API, пауза {retry_after} сек")
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    delay = self._per_chat_interval
+                elif e.error_code < 500:
+                    raise
+            except TRANSIENT_ERRORS:
+                pass
+            attempt += 1
+            if attempt > self._max_retries:
+                raise RuntimeError(f"не удалось отправить сообщение после {self._max_retries} повторов")
+            await asyncio.sleep(delay)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                status = 'sent' if await self._send_with_retries(chat_id) else 'skipped'
+            except Exception as e:
+                logger.error(f"[BROADCAST] Ошибка отправки сообщения пользователю {chat_id}: {e}")
+                status = 'failed'
+            try:
+                BROADCAST_MESSAGES.inc(result=status)
+                if status == 'sent':
+                    self.success_count += 1
+                elif status == 'skipped':
+                    self.skip_count += 1
+                else:
+                    self.fail_count += 1
+                if self._on_result:
+                    self._on_result(chat_id, status)
+            except Exception as e:
+                logger.error(f"[BROADCAST] Ошибка сохранения результата для {chat_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            await self._safe_progress()
+
+    async def _safe_progress(self):
+        try:
+            await self._on_progress(self.done_count, self.success_count, self.fail_count, self.skip_count, self.total)
+        except Exception as e:
+            logger.error(f"Ошибка обновления прогресс-бара: {e}")
+
+    async def run(self, recipients: Iterable[int]):
+        """Рассылает сообщение всем получателям и возвращает (успешно, неудачно, пропущено)."""
+        recipients = list(recipients)
+        self.total = self.done_count + len(recipients)
+        queue = asyncio.Queue()
+        for chat_id in recipients:
+            queue.put_nowait(chat_id)
+
+        tasks = [asyncio.create_task(self._worker(queue)) for _ in range(min(self._workers, self.total))]
+        if self._on_progress:
+            tasks.append(asyncio.create_task(self._report_progress()))
+        try:
+            await queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._on_progress:
+            await self._safe_progress()
+        return self.success_count, self.fail_count, self.skip_count
+
+
+class BroadcastStore:
+    """Журнал заданий рассылки и доставок в локальной базе SQLite.
+
+    Для каждого задания хранится список получателей со статусом доставки,
+    поэтому после перезапуска бота рассылка продолжается только по тем,
+    кто еще не получил сообщение.
+
+    Итоги доставок копятся в памяти и записываются пакетами в отдельном потоке:
+    каждые ``FLUSH_EVERY`` записей или раз в ``FLUSH_INTERVAL`` секунд, а также
+    при вызове ``flush``. После перезапуска повторно отправятся только получатели
+    из последнего незаписанного пакета.
+    """
+
+    # Размер пакета итогов доставки, в числе получателей
+    FLUSH_EVERY = 200
+    # Как часто записывать неполный пакет, сек
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._pending = []
+        self._flushed_at = time.monotonic()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        # Соединение общее для цикла событий и потока записи итогов
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                chat_id INTEGER,
+                progress_message_id INTEGER,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id),
+                chat_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                PRIMARY KEY (job_id, chat_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status
+                ON broadcast_deliveries (job_id, status);
+        """)
+        self._db.commit()
+
+    def create_job(self, text: str, recipients: Iterable[int], chat_id: int = None,
+                   progress_message_id: int = None, skipped: int = 0) -> int:
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO broadcast_jobs (text, chat_id, progress_message_id, skipped, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (text, chat_id, progress_message_id, skipped, time.time()))
+            job_id = cursor.lastrowid
+            self._db.executemany(
+                "INSERT OR IGNORE INTO broadcast_deliveries (job_id, chat_id) VALUES (?, ?)",
+                ((job_id, recipient) for recipient in recipients))
+        return job_id
+
+    def get_job(self, job_id: int):
+        with self._lock:
+            return self._db.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def unfinished_jobs(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id").fetchall()
+
+    def pending_recipients(self, job_id: int):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending'",
+                (job_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self, job_id: int):
+        """Возвращает (отправлено, не доставлено, пропущено, ожидает) для задания."""
+        with self._lock:
+            rows = dict(self._db.execute(
+                "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY status",
+                (job_id,)).fetchall())
+        return rows.get('sent', 0), rows.get('failed', 0), rows.get('skipped', 0), rows.get('pending', 0)
+
+    def record(self, job_id: int, chat_id: int, status: str):
+        """Запоминает итог доставки получателю: sent, failed или skipped."""
+        self._pending.append((status, job_id, chat_id))
+        due = (len(self._pending) >= self.FLUSH_EVERY
+               or time.monotonic() - self._flushed_at >= self.FLUSH_INTERVAL)
+        if due and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Записывает накопленные итоги доставок в базу."""
+        # Пакеты записываются по очереди, чтобы не менять порядок итогов
+        async with self._flush_lock:
+            rows, self._pending = self._pending, []
+            self._flushed_at = time.monotonic()
+            if rows:
+                await asyncio.to_thread(self._write_results, rows)
+
+    def _write_results(self, rows):
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE broadcast_deliveries SET status = ? WHERE job_id = ? AND chat_id = ?", rows)
+
+    def finish_job(self, job_id: int):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?",
+                (time.time(), job_id))
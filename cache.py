@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Ограниченный по размеру кеш с временем жизни записей.
+
+    При переполнении вытесняются давно не использованные записи (LRU),
+    устаревшие записи удаляются при обращении к ним.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
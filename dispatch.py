@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from collections import Counter
+
+from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate
+from telebot.types import CallbackQuery
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('subvpn.dispatch')
+
+REJECTED_UPDATES = REGISTRY.counter('subvpn_updates_rejected_total', 'Обновления, отклоненные из-за перегрузки')
+
+
+class UpdateGate(BaseMiddleware):
+    """Ограничивает параллельную обработку сообщений и нажатий кнопок.
+
+    От каждого пользователя одновременно обрабатывается не более одного обновления.
+    Сообщения пользователя ждут своей очереди и не теряются: когда в очереди уже
+    ``max_pending_per_user`` обновлений, отбрасываются только повторы команд, которые
+    и так ждут обработки. Нажатие кнопки во время обработки предыдущего обновления
+    отбрасывается с ответом ``busy_text``. Всего одновременно обрабатывается не более
+    ``max_concurrent`` обновлений; нажатие кнопки, не дождавшееся свободного места
+    за ``max_wait`` секунд, также получает ответ ``busy_text``.
+    """
+
+    def __init__(self, bot, max_concurrent: int = 50, max_wait: float = 2.0,
+                 max_pending_per_user: int = 5, busy_text: str = "⏳ Обрабатываю предыдущий запрос, подождите..."):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+        self.bot = bot
+        self.max_wait = max_wait
+        self.max_pending_per_user = max_pending_per_user
+        self.busy_text = busy_text
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(max_concurrent)
+        # ID пользователя -> [блокировка, число обновлений в обработке и в очереди, ожидающие команды]
+        self._users = {}
+        REGISTRY.gauge('subvpn_updates_in_flight', 'Обрабатываемые обновления', lambda: self.in_flight)
+        REGISTRY.gauge('subvpn_updates_waiting', 'Обновления, ожидающие обработки',
+                       lambda: sum(entry[1] for entry in self._users.values()) - self.in_flight)
+
+    @staticmethod
+    def _command(update):
+        """Команда сообщения без аргументов, например /start, или None."""
+        text = getattr(update, 'text', None)
+        if not text or not text.startswith('/'):
+            return None
+        return text.split(maxsplit=1)[0].split('@', 1)[0]
+
+    @staticmethod
+    def _user_key(update):
+        if update.from_user is not None:
+            return update.from_user.id
+        return update.chat.id
+
+    async def _reject(self, update, reason: str):
+        REJECTED_UPDATES.inc(reason=reason)
+        if isinstance(update, CallbackQuery):
+            try:
+                await self.bot.answer_callback_query(update.id, self.busy_text)
+            except Exception as e:
+                logger.error(f"Ошибка ответа на отклоненное нажатие кнопки: {e}")
+        else:
+            logger.warning(f"Отброшено сообщение пользователя {self._user_key(update)}: {reason}")
+        return CancelUpdate()
+
+    def _release_user(self, key, command=None):
+        entry = self._users[key]
+        entry[1] -= 1
+        if command is not None:
+            entry[2][command] -= 1
+        if entry[0].locked():
+            entry[0].release()
+        if entry[1] == 0:
+            del self._users[key]
+
+    async def pre_process(self, update, data):
+        key = self._user_key(update)
+        entry = self._users.setdefault(key, [asyncio.Lock(), 0, Counter()])
+        is_callback = isinstance(update, CallbackQuery)
+        if is_callback and entry[0].locked():
+            # Повторное нажатие, пока обрабатывается предыдущее, устарело
+            if entry[1] == 0:
+                del self._users[key]
+            return await self._reject(update, 'user_busy')
+        command = None if is_callback else self._command(update)
+        if entry[1] >= self.max_pending_per_user and entry[2][command] > 0:
+            # Та же команда уже ждет обработки, повтор ничего не добавит
+            return await self._reject(update, 'duplicate_command')
+
+        entry[1] += 1
+        if command is not None:
+            entry[2][command] += 1
+        await entry[0].acquire()
+        try:
+            if is_callback:
+                await asyncio.wait_for(self._slots.acquire(), self.max_wait)
+            else:
+                await self._slots.acquire()
+        except asyncio.TimeoutError:
+            self._release_user(key)
+            return await self._reject(update, 'overloaded')
+        self.in_flight += 1
+        data['gate_key'] = key
+        data['gate_command'] = command
+
+    async def post_process(self, update, data, exception):
+        key = data.get('gate_key')
+        if key is None:
+            return
+        self.in_flight -= 1
+        self._slots.release()
+        self._release_user(key, data.get('gate_command'))
+
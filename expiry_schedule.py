@@ -0,0 +1,114 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('subvpn.expiry')
+
+
+class ExpirySchedule:
+    """Сроки действия подписок пользователей в куче с ближайшим сроком наверху.
+
+    Для каждого пользователя хранятся два срока: истечение подписки ``expire``
+    и порог удаления через ``removal_age`` секунд после него. ``run`` спит до
+    ближайшего срока и передает обработчику только пользователей, чей срок
+    наступил. Уже прошедшие сроки в расписание не попадают: таких пользователей
+    обрабатывает периодическая проверка подписок. Изменение или удаление
+    пользователя не ищет его записи в куче: устаревшие записи отбрасываются при
+    извлечении, а куча пересобирается, когда их становится слишком много.
+    """
+
+    # Сколько спать, если сроков нет или ближайший далеко, сек
+    MAX_SLEEP = 3600
+
+    def __init__(self, removal_age: float):
+        self.removal_age = removal_age
+        # (срок, username, expire, для которого вычислен срок)
+        self._heap = []
+        # username -> текущий expire пользователя
+        self._expires = {}
+        self._changed = asyncio.Event()
+        REGISTRY.gauge('subvpn_expiry_schedule_users', 'Пользователи в расписании сроков подписки',
+                       lambda: len(self._expires))
+
+    def __len__(self):
+        return len(self._expires)
+
+    def set(self, username: str, expire: Optional[int]):
+        """Запоминает срок действия подписки пользователя. ``None`` - бессрочная подписка."""
+        if expire is None:
+            self.remove(username)
+            return
+        if self._expires.get(username) == expire:
+            return
+        self._expires[username] = expire
+        now = time.time()
+        # Порог удаления сдвинут на секунду, чтобы к пробуждению он был уже пройден
+        deadlines = [deadline for deadline in (expire, expire + self.removal_age + 1) if deadline > now]
+        if not deadlines:
+            return
+        wake = not self._heap or deadlines[0] < self._heap[0][0]
+        for deadline in deadlines:
+            heapq.heappush(self._heap, (deadline, username, expire))
+        if len(self._heap) > 4 * len(self._expires) + 1000:
+            self._compact()
+        if wake:
+            self._changed.set()
+
+    def load(self, users: Iterable[tuple]):
+        """Заполняет расписание парами (username, expire)."""
+        for username, expire in users:
+            self.set(username, expire)
+
+    def remove(self, username: str):
+        self._expires.pop(username, None)
+
+    def retain(self, usernames: set):
+        """Удаляет пользователей, которых нет в ``usernames``."""
+        for username in set(self._expires) - usernames:
+            del self._expires[username]
+
+    def _is_current(self, entry) -> bool:
+        return self._expires.get(entry[1]) == entry[2]
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._is_current(entry)]
+        heapq.heapify(self._heap)
+
+    def next_deadline(self) -> Optional[float]:
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float = None) -> list:
+        """Извлекает пользователей, чей срок наступил к ``now``."""
+        now = time.time() if now is None else now
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                due[entry[1]] = None
+        return list(due)
+
+    async def run(self, handler: Callable[[list], Awaitable]):
+        """Вызывает ``handler(usernames)`` каждый раз, когда наступают сроки пользователей."""
+        while True:
+            self._changed.clear()
+            deadline = self.next_deadline()
+            delay = self.MAX_SLEEP if deadline is None else min(deadline - time.time(), self.MAX_SLEEP)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self.pop_due()
+            if not due:
+                continue
+            try:
+                await handler(due)
+            except Exception as e:
+                logger.error(f"Ошибка обработки наступивших сроков подписки: {e}")
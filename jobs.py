@@ -0,0 +1,165 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import random
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+from scheduler.asyncio import Scheduler
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('subvpn.jobs')
+
+JOB_DURATION = REGISTRY.histogram('subvpn_job_duration_seconds', 'Длительность запусков периодических задач')
+JOB_SKIPS = REGISTRY.counter('subvpn_job_skipped_total', 'Запуски периодических задач, пропущенные из-за наложения')
+
+
+class Job:
+    """Периодическая задача, запуски которой никогда не накладываются друг на друга.
+
+    Если задача еще выполняется, новый запуск пропускается. Перед стартом
+    выжидается случайная задержка до ``jitter`` секунд, а выполнение прерывается
+    через ``timeout`` секунд. Длительность и итог последнего запуска сохраняются.
+    Код, работающий с теми же данными вне расписания, выполняется в ``exclusive()``
+    и не пересекается с запусками задачи.
+    """
+
+    def __init__(self, name: str, func: Callable[[], Awaitable], *,
+                 timeout: Optional[float] = None, jitter: float = 0.0):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.jitter = jitter
+        # Запуск начат, но ждет блокировку или случайную задержку
+        self.waiting_since: Optional[float] = None
+        self.running_since: Optional[float] = None
+        self.last_started_at: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_outcome: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.outcomes = Counter()
+        self.accepting = True
+        self._active = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._active
+
+    async def run(self):
+        """Выполняет задачу, если она сейчас не выполняется. Возвращает False, если запуск пропущен."""
+        if self.running or not self.accepting:
+            self.outcomes['skipped'] += 1
+            JOB_SKIPS.inc(job=self.name)
+            logger.warning(f"Задача {self.name} уже выполняется или бот останавливается, запуск пропущен")
+            return False
+        self._active = True
+        self.waiting_since = time.time()
+        try:
+            await self._run()
+        finally:
+            self._active = False
+            self.waiting_since = None
+        return True
+
+    async def _run(self):
+        async with self._lock:
+            if self.jitter:
+                await asyncio.sleep(random.uniform(0, self.jitter))
+            self.waiting_since = None
+            self.running_since = time.time()
+            started_at = time.perf_counter()
+            outcome = 'failed'
+            error = None
+            try:
+                async with asyncio.timeout(self.timeout):
+                    await self.func()
+                outcome = 'ok'
+            except TimeoutError:
+                outcome = 'timeout'
+                error = f"превышен таймаут {self.timeout:g} сек"
+                logger.error(f"Задача {self.name} прервана: {error}")
+            except asyncio.CancelledError:
+                outcome = 'cancelled'
+                raise
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Ошибка выполнения задачи {self.name}: {e}")
+            finally:
+                self.last_started_at = self.running_since
+                self.running_since = None
+                self.last_duration = time.perf_counter() - started_at
+                self.last_outcome = outcome
+                self.last_error = error
+                self.outcomes[outcome] += 1
+                JOB_DURATION.observe(self.last_duration, job=self.name, outcome=outcome)
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        """Дожидается завершения текущего запуска и не дает начаться следующему, пока выполняется блок."""
+        async with self._lock:
+            yield
+
+    async def wait_idle(self):
+        async with self._lock:
+            pass
+
+
+class JobScheduler:
+    """Периодические задачи бота поверх scheduler.asyncio.Scheduler.
+
+    Каждая задача выполняется через Job, поэтому запуски по расписанию и первый
+    запуск после старта не накладываются. Пропущенные из-за долгого выполнения
+    запуски по расписанию не догоняются.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self._plans = []
+        self._scheduler: Optional[Scheduler] = None
+
+    def add(self, name: str, func: Callable[[], Awaitable], period: datetime.timedelta, *,
+            first_delay: Optional[datetime.timedelta] = None,
+            timeout: Optional[float] = None, jitter: float = 0.0) -> Job:
+        """Регистрирует задачу, выполняемую каждые ``period`` и один раз через ``first_delay`` после запуска."""
+        job = self.jobs[name] = Job(name, func, timeout=timeout, jitter=jitter)
+        self._plans.append((job, period, first_delay))
+        return job
+
+    def start(self):
+        self._scheduler = Scheduler(loop=asyncio.get_running_loop())
+        for job, period, first_delay in self._plans:
+            if first_delay is not None:
+                self._scheduler.once(first_delay, job.run, alias=job.name)
+            self._scheduler.cyclic(period, job.run, alias=job.name, skip_missing=True)
+
+    def next_run(self, name: str) -> Optional[datetime.datetime]:
+        """Ближайшее запланированное время запуска задачи."""
+        if self._scheduler is None:
+            return None
+        planned = [job.datetime for job in self._scheduler.jobs if job.alias == name]
+        return min(planned) if planned else None
+
+    async def shutdown(self, grace: float = 30.0):
+        """Останавливает расписание, дает выполняющимся задачам ``grace`` секунд и отменяет их."""
+        for job in self.jobs.values():
+            job.accepting = False
+        running = [job for job in self.jobs.values() if job.running]
+        if running:
+            logger.info(f"Ожидание завершения задач: {', '.join(job.name for job in running)}")
+            await self._wait_idle(running, grace)
+        if self._scheduler is not None:
+            # Отменяет ожидание следующих запусков и задачи, не успевшие завершиться
+            self._scheduler.delete_jobs()
+            await self._wait_idle([job for job in self.jobs.values() if job.running], 5)
+
+    @staticmethod
+    async def _wait_idle(jobs, timeout: float):
+        if not jobs:
+            return
+        _, pending = await asyncio.wait([asyncio.create_task(job.wait_idle()) for job in jobs], timeout=timeout)
+        for task in pending:
+            task.cancel()
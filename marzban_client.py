@@ -0,0 +1,239 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+from typing import Callable, Optional
+
+import httpx
+from marzban import MarzbanAPI, UserCreate, UserResponse
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('subvpn.marzban')
+
+PANEL_REQUESTS = REGISTRY.histogram('subvpn_marzban_request_duration_seconds', 'Длительность запросов к панели Marzban')
+
+
+class MarzbanClient:
+    """Общий клиент панели Marzban с кешированием токена доступа.
+
+    Токен запрашивается один раз и переиспользуется всеми обработчиками и
+    задачами, пока не приблизится срок его истечения (поле ``exp`` в JWT).
+    Одновременные обновления схлопываются в один запрос к панели, а ответ
+    401 на любой вызов приводит к одному повторному входу и повтору вызова.
+
+    Все запросы идут через один HTTP-клиент с keep-alive и пулом не более
+    ``max_connections`` соединений. Запросы сверх пула ждут в очереди, а на
+    весь вызов вместе с ожиданием отводится не более ``call_timeout`` секунд.
+    """
+
+    def __init__(self, api: MarzbanAPI, username: str, password: str,
+                 refresh_margin: int = 60, default_ttl: int = 1440 * 60,
+                 max_connections: int = 20, call_timeout: float = 15.0, keepalive_expiry: float = 60.0):
+        self.api = api
+        if api.client is not None:
+            # Клиент без SSH-туннеля заменяем настроенным: пул соединений, keep-alive и таймауты
+            api.client = httpx.AsyncClient(
+                base_url=api.base_url,
+                verify=api.verify,
+                timeout=httpx.Timeout(call_timeout),
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections,
+                                    keepalive_expiry=keepalive_expiry))
+        self.call_timeout = call_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._slots = asyncio.Semaphore(max_connections)
+        self._username = username
+        self._password = password
+        self._refresh_margin = refresh_margin
+        self._default_ttl = default_ttl
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._provisioning = {}
+        REGISTRY.gauge('subvpn_marzban_requests_in_flight', 'Выполняющиеся запросы к панели Marzban',
+                       lambda: self.in_flight)
+        REGISTRY.gauge('subvpn_marzban_requests_queued', 'Запросы к панели Marzban, ожидающие свободного соединения',
+                       lambda: self.queued)
+
+    async def start(self):
+        """Получает токен и открывает первое соединение с панелью при запуске бота."""
+        try:
+            await self.get_token()
+        except Exception as e:
+            # Бот должен запуститься и при недоступной панели, вход повторится при первом вызове
+            logger.error(f"Не удалось подключиться к панели Marzban при запуске: {e}")
+
+    async def close(self):
+        """Закрывает соединения с панелью."""
+        await self.api.close()
+
+    @staticmethod
+    def _decode_expiry(token: str) -> Optional[float]:
+        """Достает время истечения из JWT без проверки подписи."""
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def _token_is_fresh(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at - self._refresh_margin
+
+    async def get_token(self) -> str:
+        """Возвращает действующий токен, при необходимости обновляя его."""
+        if self._token_is_fresh():
+            return self._token
+        async with self._refresh_lock:
+            # Пока мы ждали блокировку, токен мог обновить другой обработчик
+            if not self._token_is_fresh():
+                token = await self._timed('get_token', self.api.get_token,
+                                          username=self._username, password=self._password)
+                self._token = token.access_token
+                self._expires_at = self._decode_expiry(self._token) or time.time() + self._default_ttl
+                logger.info("Получен новый токен панели Marzban")
+            return self._token
+
+    def invalidate(self, token: str):
+        """Сбрасывает токен, если он еще не был заменен более новым."""
+        if self._token == token:
+            self._token = None
+            self._expires_at = 0.0
+
+    async def _timed(self, method: str, func, **kwargs):
+        started_at = time.perf_counter()
+        status = 'error'
+        waiting = True
+        self.queued += 1
+        try:
+            async with asyncio.timeout(self.call_timeout):
+                async with self._slots:
+                    self.queued -= 1
+                    waiting = False
+                    self.in_flight += 1
+                    try:
+                        result = await func(**kwargs)
+                    finally:
+                        self.in_flight -= 1
+            status = 'ok'
+            return result
+        except httpx.HTTPStatusError as e:
+            status = str(e.response.status_code)
+            raise
+        except httpx.TimeoutException:
+            status = 'timeout'
+            raise
+        except TimeoutError:
+            status = 'timeout'
+            raise TimeoutError(f"Панель не ответила на {method} за {self.call_timeout:g} сек") from None
+        finally:
+            if waiting:
+                self.queued -= 1
+            PANEL_REQUESTS.observe(time.perf_counter() - started_at, method=method, status=status)
+
+    async def call(self, method: str, **kwargs):
+        """Вызывает метод MarzbanAPI, подставляя токен доступа.
+
+        При ответе 401 токен сбрасывается и вызов повторяется один раз.
+        """
+        return await self._call(method, getattr(self.api, method), **kwargs)
+
+    async def _call(self, method: str, func, **kwargs):
+        token = await self.get_token()
+        try:
+            return await self._timed(method, func, token=token, **kwargs)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 401:
+                raise
+            logger.warning(f"Панель отклонила токен при вызове {method}, выполняю повторный вход")
+            self.invalidate(token)
+            token = await self.get_token()
+            return await self._timed(method, func, token=token, **kwargs)
+
+    async def _put_user_fields(self, username: str, fields: dict, token: str) -> UserResponse:
+        # UserModify подставляет значения по умолчанию, поэтому тело запроса собираем сами
+        response = await self.api.client.put(f"/api/user/{username}", json=fields,
+                                             headers={"Authorization": f"Bearer {token}"})
+        response.raise_for_status()
+        return UserResponse(**response.json())
+
+    async def modify_users(self, changes: dict, concurrency: int = 10) -> dict:
+        """Изменяет поля нескольких пользователей панели.
+
+        ``changes`` - словарь username -> изменяемые поля; в запросах передаются
+        только эти поля. Запросы идут параллельно, не более ``concurrency``
+        одновременно, по общим keep-alive соединениям клиента. Возвращает словарь
+        username -> UserResponse или исключение, если изменить пользователя не удалось.
+        """
+        limit = asyncio.Semaphore(concurrency)
+
+        async def modify(username, fields):
+            async with limit:
+                try:
+                    return username, await self._call('modify_user', self._put_user_fields,
+                                                      username=username, fields=fields)
+                except Exception as e:
+                    return username, e
+
+        return dict(await asyncio.gather(*(modify(username, fields) for username, fields in changes.items())))
+
+    async def get_or_create_user(self, username: str, new_user: Callable[[], UserCreate]) -> UserResponse:
+        """Возвращает пользователя панели, создавая его, если его нет.
+
+        Одновременные вызовы для одного ``username`` выполняют один общий поиск
+        и одно создание. Пользователь создается только при ответе 404, остальные
+        ошибки панели пробрасываются. Ответ 409 при создании означает, что
+        пользователя уже создал кто-то другой, и он просто запрашивается заново.
+        """
+        task = self._provisioning.get(username)
+        if task is None:
+            task = asyncio.ensure_future(self._get_or_create_user(username, new_user))
+            self._provisioning[username] = task
+            task.add_done_callback(lambda _: self._provisioning.pop(username, None))
+        # Отмена одного из ожидающих обработчиков не должна прерывать общий запрос
+        return await asyncio.shield(task)
+
+    async def _get_or_create_user(self, username: str, new_user: Callable[[], UserCreate]) -> UserResponse:
+        try:
+            return await self.call('get_user', username=username)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+        try:
+            user = await self.call('add_user', user=new_user())
+            logger.info(f"Создан новый пользователь: {username}")
+            return user
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 409:
+                raise
+        logger.info(f"Пользователь {username} уже создан, запрашиваю его из панели")
+        return await self.call('get_user', username=username)
+
+    async def iter_users(self, page_size: int = 500, reverse: bool = False, **filters):
+        """Постранично обходит пользователей панели, не загружая их всех в память.
+
+        ``filters`` передаются в get_users как серверные фильтры (status, search, sort).
+        При ``reverse=True`` страницы читаются с конца списка: изменение или удаление
+        уже полученных пользователей не сдвигает смещения еще не прочитанных страниц.
+        """
+        if reverse:
+            probe = await self.call('get_users', offset=0, limit=1, **filters)
+            offset = (max(probe.total, 1) - 1) // page_size * page_size
+            while offset >= 0:
+                page = await self.call('get_users', offset=offset, limit=page_size, **filters)
+                for user in reversed(page.users):
+                    yield user
+                offset -= page_size
+            return
+
+        offset = 0
+        while True:
+            page = await self.call('get_users', offset=offset, limit=page_size, **filters)
+            for user in page.users:
+                yield user
+            if len(page.users) < page_size:
+                return
+            offset += page_size
@@ -0,0 +1,151 @@
+import functools
+import math
+import time
+from typing import Callable, Optional
+
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in key) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+    """Монотонно растущий счетчик с метками."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    """Текущее значение с метками; может вычисляться функцией в момент выгрузки."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, func: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation)
+        self._func = func
+
+    def set(self, value: float, **labels):
+        self._values[_label_key(labels)] = value
+
+    def samples(self):
+        if self._func is not None:
+            yield self.name, (), self._func()
+        yield from super().samples()
+
+
+class Histogram:
+    """Распределение значений (обычно длительностей) по корзинам с метками."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', key + (('le', _format_value(bound)),), cumulative
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, count
+
+
+class Registry:
+    """Набор метрик процесса с выгрузкой в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str, func: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, func))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, value in metric.samples():
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор корутины, записывающий длительность ее выполнения в гистограмму."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started_at, **labels)
+        return wrapper
+    return decorator
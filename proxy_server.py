@@ -1,45 +1,30 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import collections
+import hashlib
+import hmac
+import html
+import importlib.util
+import logging
+import random
+import signal
+import sys
+import time
+
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.responses import RedirectResponse, HTMLResponse
 import uvicorn
+from uvicorn._subprocess import get_subprocess
+from uvicorn.supervisors.multiprocess import HANDLED_SIGNALS, Multiprocess
 import urllib.parse
 import os
 
+from app_catalog import APP_URL_SCHEMES
+
 app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
 
-# Словарь с URL-схемами для разных приложений
-APP_URL_SCHEMES = {
-    'ios': {
-        'streisand': 'streisand://import/{url}#{name}',
-        'karing': 'karing://install-config?url={url}&name={name}',
-        'foxray': 'foxray://yiguo.dev/sub/add/?url={url}#{name}',
-        'v2box': 'v2box://install-sub?url={url}&name={name}',
-        'singbox': 'sing-box://import-remote-profile?url={url}#{name}',
-        'happ': 'happ://add/{url}'
-    },
-    'android': {
-        'nekoray': 'sn://subscription?url={url}&name={name}',
-        'v2rayng': 'v2rayng://install-sub?url={url}&name={name}',
-        'hiddify': 'hiddify://install-config/?url={url}'
-    },
-    'pc': {
-        'clashx': 'clashx://install-config?url={url}',
-        'clash': 'clash://install-config?url={url}',
-        'hiddify': 'hiddify://install-config/?url={url}'
-    }
-}
-@app.get("/redirect/{system}/{app}")
-async def redirect_to_app(system: str, app: str, url: str, name: str = None):
-    """Перенаправляет на URL-схему приложения."""
-    if system not in APP_URL_SCHEMES or app not in APP_URL_SCHEMES[system]:
-        raise HTTPException(status_code=404, detail="Invalid system or app")
-    
-    scheme = APP_URL_SCHEMES[system][app]
-    
-    # Используем стандартное форматирование для всех приложений
-    app_url = scheme.format(url=url, name=name if name else "")
-    
-    # Создаем HTML-страницу с автоматическим перенаправлением
-    html_content = f"""
+# Страница с автоматическим перенаправлением, разбитая на части вокруг ссылки на приложение
+REDIRECT_PAGE_PARTS = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -51,25 +36,189 @@ async def redirect_to_app(system: str, app: str, url: str, name: str = None):
         <p>Если перенаправление не произошло автоматически, <a href="{app_url}">нажмите здесь</a></p>
     </body>
     </html>
-    """
+    """.split("{app_url}")
+
+# Режим ответа по умолчанию: html - страница с перенаправлением, 302 - HTTP-редирект
+REDIRECT_MODE = os.environ.get("REDIRECT_MODE", "html")
+# Ссылка содержит персональный токен подписки, поэтому ответ можно кешировать только в браузере
+REDIRECT_CACHE_CONTROL = f"private, max-age={int(os.environ.get('REDIRECT_CACHE_MAX_AGE', 3600))}"
+
+# Схемы приложений, собранные при запуске: (system, app) -> str.format схемы
+COMPILED_SCHEMES = {
+    (system, app_name): scheme.format
+    for system, apps in APP_URL_SCHEMES.items()
+    for app_name, scheme in apps.items()
+}
+
+async def redirect_to_app(request: Request):
+    """Перенаправляет на URL-схему приложения."""
+    path_params = request.path_params
+    format_scheme = COMPILED_SCHEMES.get((path_params["system"], path_params["app"]))
+    if format_scheme is None:
+        return Response("Invalid system or app", status_code=404, media_type="text/plain")
+    
+    query = request.query_params
+    url = query.get("url")
+    if url is None:
+        return Response("Missing url", status_code=400, media_type="text/plain")
+    app_url = format_scheme(url=url, name=query.get("name") or "")
+    
+    mode = query.get("mode", REDIRECT_MODE)
     
-    return HTMLResponse(content=html_content)
+    etag = '"' + hashlib.blake2b(f"{mode}:{app_url}".encode(), digest_size=12).hexdigest() + '"'
+    headers = {"Cache-Control": REDIRECT_CACHE_CONTROL, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    if mode == "302":
+        headers["Location"] = app_url
+        return Response(status_code=302, headers=headers)
+    return HTMLResponse(html.escape(app_url).join(REDIRECT_PAGE_PARTS), headers=headers)
 
-if __name__ == "__main__":
-    port = int(os.environ.get("PROXY_PORT", "8443"))
+# Маршрут без валидации FastAPI: параметры разбираются вручную в redirect_to_app
+app.add_route("/redirect/{system}/{app}", redirect_to_app, methods=["GET"])
+
+def add_telegram_webhook(app: FastAPI, secret: str, updates: asyncio.Queue):
+    """Регистрирует endpoint /telegram/<secret> для приема обновлений Telegram.
+
+    Обновления складываются в ограниченную очередь, которую разбирают обработчики бота.
+    Запросы без правильного заголовка X-Telegram-Bot-Api-Secret-Token отклоняются.
+    Если очередь переполнена, возвращается 503 и Telegram повторит доставку позже.
+    """
+    @app.post(f"/telegram/{secret}", include_in_schema=False)
+    async def telegram_webhook(request: Request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, secret):
+            raise HTTPException(status_code=403, detail="Invalid secret token")
+        try:
+            updates.put_nowait(await request.json())
+        except asyncio.QueueFull:
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+def find_ssl_files():
+    """Возвращает пути (ключ, сертификат) для TLS."""
     # Проверяем наличие локальных сертификатов
     if os.path.exists("./certs/key.pem") and os.path.exists("./certs/fullchain.pem"):
-        ssl_keyfile = "./certs/key.pem"
-        ssl_certfile = "./certs/fullchain.pem"
-    else:
-        # Если локальных нет, используем серверные
-        ssl_keyfile = "/certs/key.pem"
-        ssl_certfile = "/certs/fullchain.pem"
+        return "./certs/key.pem", "./certs/fullchain.pem"
+    # Если локальных нет, используем серверные
+    return "/certs/key.pem", "/certs/fullchain.pem"
+
+class RecyclingSupervisor(Multiprocess):
+    """Менеджер воркеров uvicorn, который перезапускает завершившиеся воркеры.
+
+    Воркер завершается сам после ``limit_max_requests`` запросов, дообслужив
+    открытые соединения, и заменяется новым. Лимит для каждого нового воркера
+    увеличивается на случайную добавку, чтобы воркеры не перезапускались одновременно.
+
+    Воркер, завершившийся с ошибкой, перезапускается с нарастающей задержкой. Если
+    за ``failure_window`` секунд набирается ``max_failures`` таких завершений,
+    менеджер останавливается с ненулевым кодом, и дальше решает supervisord.
+    """
+
+    # Максимальная задержка перезапуска упавшего воркера, сек
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, config: uvicorn.Config, target, sockets, max_requests_jitter: int = 0,
+                 max_failures: int = 5, failure_window: float = 60.0):
+        super().__init__(config, target, sockets)
+        self._max_requests = config.limit_max_requests
+        self._max_requests_jitter = max_requests_jitter
+        self._max_failures = max_failures
+        self._failure_window = failure_window
+        self._failures = collections.deque()
+        # Номер воркера -> время, когда его можно запустить снова
+        self._restart_at = {}
+
+    def spawn(self):
+        if self._max_requests:
+            self.config.limit_max_requests = self._max_requests + random.randint(0, self._max_requests_jitter)
+        process = get_subprocess(config=self.config, target=self.target, sockets=self.sockets)
+        process.start()
+        return process
+
+    def startup(self):
+        for sig in HANDLED_SIGNALS:
+            signal.signal(sig, self.signal_handler)
+        self.processes = [self.spawn() for _ in range(self.config.workers)]
+
+    def run(self) -> int:
+        """Управляет воркерами до сигнала остановки. Возвращает код завершения процесса."""
+        self.startup()
+        exit_code = 0
+        while not self.should_exit.wait(0.5):
+            now = time.monotonic()
+            for idx, process in enumerate(self.processes):
+                if idx in self._restart_at:
+                    if now >= self._restart_at[idx]:
+                        del self._restart_at[idx]
+                        self.processes[idx] = self.spawn()
+                    continue
+                if process.is_alive():
+                    continue
+                process.join()
+                if process.exitcode == 0:
+                    # Воркер обслужил limit_max_requests запросов и завершился штатно
+                    self.processes[idx] = self.spawn()
+                    continue
+                self._failures.append(now)
+                while now - self._failures[0] > self._failure_window:
+                    self._failures.popleft()
+                if len(self._failures) >= self._max_failures:
+                    logger.error(f"Воркеры упали {len(self._failures)} раз за {self._failure_window:g} сек, "
+                                 f"останавливаю прокси-сервер")
+                    exit_code = 1
+                    self.should_exit.set()
+                    break
+                delay = min(2 ** (len(self._failures) - 1), self.MAX_RESTART_DELAY)
+                logger.warning(f"Воркер {process.pid} завершился с кодом {process.exitcode}, "
+                               f"перезапуск через {delay} сек")
+                self._restart_at[idx] = now + delay
+        self.shutdown()
+        return exit_code
+
+def available_cpus():
+    """Число ядер, доступных процессу (с учетом ограничений контейнера по affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PROXY_PORT", "8443"))
+    ssl_keyfile, ssl_certfile = find_ssl_files()
+    workers = int(os.environ.get("PROXY_WORKERS", 0)) or available_cpus()
+    max_requests = int(os.environ.get("PROXY_MAX_REQUESTS", 50000))
     
-    uvicorn.run(
-        app, 
-        host="0.0.0.0", 
+    # uvloop и httptools используются, только если они установлены
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    config = uvicorn.Config(
+        "proxy_server:app",
+        host="0.0.0.0",
         port=port,
         ssl_keyfile=ssl_keyfile,
-        ssl_certfile=ssl_certfile
-    ) 
\ No newline at end of file
+        ssl_certfile=ssl_certfile,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=int(os.environ.get("PROXY_BACKLOG", 2048)),
+        timeout_keep_alive=int(os.environ.get("PROXY_KEEPALIVE", 30)),
+        # Лимит запросов имеет смысл, только если завершившихся воркеров перезапускает RecyclingSupervisor
+        limit_max_requests=(max_requests or None) if workers > 1 else None,
+        timeout_graceful_shutdown=int(os.environ.get("PROXY_GRACEFUL_TIMEOUT", 10)),
+        access_log=os.environ.get("PROXY_ACCESS_LOG", "false").lower() in ("1", "true", "yes")
+    )
+    # Логирование uvicorn настраивается при создании Config
+    logger.info(
+        f"Прокси-сервер: воркеров {workers}, цикл событий {loop}, HTTP-парсер {http}")
+    server = uvicorn.Server(config)
+    if workers > 1:
+        sys.exit(RecyclingSupervisor(
+            config,
+            target=server.run,
+            sockets=[config.bind_socket()],
+            max_requests_jitter=max_requests // 10
+        ).run())
+    else:
+        server.run()
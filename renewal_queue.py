@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from broadcast import TokenBucket
+from cache import TTLCache
+from metrics import REGISTRY
+
+logger = logging.getLogger('subvpn.renewal')
+
+INSTANT_RENEWALS = REGISTRY.counter('subvpn_instant_renewals_total', 'Продления подписки по событию вступления в канал')
+
+
+class RenewalQueue:
+    """Очередь продлений подписки по событиям вступления пользователей в канал.
+
+    ``renew(tg_user_id)`` продлевает подписку одного пользователя. Повторные
+    события для пользователя, который уже ждет в очереди или был обработан
+    меньше ``cooldown`` секунд назад, отбрасываются. Продления выполняются
+    ``workers`` воркерами не чаще ``rate`` в секунду. При переполнении очереди
+    события отбрасываются: такого пользователя продлит периодическая проверка.
+    """
+
+    def __init__(self, renew: Callable[[int], Awaitable], *, rate: float = 5, workers: int = 2,
+                 maxsize: int = 1000, cooldown: float = 60, recent_size: int = 10000):
+        self._renew = renew
+        self._bucket = TokenBucket(rate)
+        self._workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._maxsize = maxsize
+        self._pending = set()
+        # Пользователи, обработанные недавно: tg_user_id -> True
+        self._recent = TTLCache(ttl=cooldown, maxsize=recent_size)
+        self._tasks = []
+        REGISTRY.gauge('subvpn_instant_renewals_queued', 'Продления по событию, ожидающие обработки',
+                       lambda: len(self._pending))
+
+    def start(self):
+        self._queue = asyncio.Queue(self._maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, tg_user_id: int) -> bool:
+        """Ставит продление пользователя в очередь. Возвращает False, если событие отброшено."""
+        if self._queue is None or tg_user_id in self._pending or self._recent.get(tg_user_id):
+            INSTANT_RENEWALS.inc(outcome='duplicate')
+            return False
+        try:
+            self._queue.put_nowait(tg_user_id)
+        except asyncio.QueueFull:
+            INSTANT_RENEWALS.inc(outcome='dropped')
+            logger.warning(f"Очередь продлений переполнена, пользователь {tg_user_id} будет продлен при проверке подписок")
+            return False
+        self._pending.add(tg_user_id)
+        return True
+
+    async def _worker(self):
+        while True:
+            tg_user_id = await self._queue.get()
+            try:
+                await self._bucket.acquire()
+                renewed = await self._renew(tg_user_id)
+                INSTANT_RENEWALS.inc(outcome='renewed' if renewed else 'skipped')
+            except Exception as e:
+                INSTANT_RENEWALS.inc(outcome='failed')
+                logger.error(f"Ошибка продления подписки пользователя {tg_user_id} по событию: {e}")
+            finally:
+                self._pending.discard(tg_user_id)
+                self._recent.set(tg_user_id, True)
+                self._queue.task_done()
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import time
+from typing import Iterable
+
+
+class RenewalStateStore:
+    """Последнее известное состояние пользователей панели в локальной базе SQLite.
+
+    Для каждого пользователя SUB_ хранятся статус и срок действия из панели,
+    результат последней проверки подписки на канал и время этой проверки.
+    По этим данным проверка подписок обрабатывает только изменившихся пользователей.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS renewal_state (
+                username TEXT PRIMARY KEY,
+                status TEXT,
+                expire INTEGER,
+                is_member INTEGER,
+                checked_at REAL NOT NULL DEFAULT 0
+            )
+        """)
+        self._db.commit()
+
+    def load(self) -> dict:
+        """Возвращает состояние всех пользователей: username -> строка таблицы."""
+        return {row['username']: row for row in self._db.execute("SELECT * FROM renewal_state")}
+
+    def get(self, username: str):
+        """Возвращает состояние пользователя или None."""
+        return self._db.execute("SELECT * FROM renewal_state WHERE username = ?", (username,)).fetchone()
+
+    def save(self, rows: Iterable[tuple]):
+        """Сохраняет строки (username, status, expire, is_member, checked_at)."""
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO renewal_state (username, status, expire, is_member, checked_at) "
+                "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def delete(self, usernames: Iterable[str]):
+        with self._db:
+            self._db.executemany("DELETE FROM renewal_state WHERE username = ?",
+                                 ((username,) for username in usernames))
+
+    def mark_stale(self, username: str):
+        """Помечает результат проверки подписки устаревшим, чтобы пользователя проверили снова."""
+        with self._db:
+            self._db.execute("UPDATE renewal_state SET checked_at = 0 WHERE username = ?", (username,))
+
+
+def needs_check(item, state, recheck_interval: float, removal_age: float, now: float = None) -> bool:
+    """Определяет, нужно ли заново обрабатывать просроченного пользователя ``item``.
+
+    Пользователь обрабатывается, если он просрочен впервые или его срок изменился,
+    если результат проверки подписки старше ``recheck_interval`` секунд или если
+    с последней проверки он пересек порог удаления ``removal_age`` секунд после истечения.
+    """
+    now = time.time() if now is None else now
+    if state is None or state['status'] != item.status or state['expire'] != item.expire:
+        return True
+    if now - state['checked_at'] >= recheck_interval:
+        return True
+    if item.expire is not None and state['checked_at'] < item.expire + removal_age <= now:
+        return True
+    return False
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from cache import TTLCache
+
+
+class MemorySessionStore:
+    """Сессии пользователей в памяти процесса с вытеснением по LRU и времени жизни."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self._cache = TTLCache(ttl=ttl, maxsize=maxsize)
+
+    async def get(self, user_id: int) -> dict:
+        return dict(self._cache.get(user_id) or {})
+
+    async def set(self, user_id: int, data: dict):
+        self._cache.set(user_id, dict(data))
+
+    async def update(self, user_id: int, **fields):
+        data = dict(self._cache.get(user_id) or {})
+        data.update(fields)
+        self._cache.set(user_id, data)
+
+
+class SQLiteSessionStore:
+    """Сессии пользователей в базе SQLite.
+
+    Сессии переживают перезапуск бота, а один файл базы на общем томе могут
+    использовать несколько процессов бота. Сессии, не обновлявшиеся дольше
+    ``ttl`` секунд, считаются истекшими и периодически удаляются.
+
+    Запросы к базе выполняются в потоках, чтобы ожидание блокировки файла,
+    занятого другим процессом, не останавливало цикл событий бота.
+    """
+
+    # Как часто удалять истекшие сессии, в числе записей
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, ttl: float):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+        self.purge()
+
+    async def get(self, user_id: int) -> dict:
+        return await asyncio.to_thread(self._locked, self._get, user_id)
+
+    async def set(self, user_id: int, data: dict):
+        await asyncio.to_thread(self._locked, self._set, user_id, data)
+
+    async def update(self, user_id: int, **fields):
+        await asyncio.to_thread(self._locked, self._update, user_id, fields)
+
+    def purge(self):
+        """Удаляет истекшие сессии."""
+        with self._lock:
+            self._purge()
+
+    def _locked(self, func, *args):
+        # Соединение общее для всех потоков, поэтому запросы к нему выполняются по очереди
+        with self._lock:
+            return func(*args)
+
+    def _get(self, user_id: int) -> dict:
+        row = self._db.execute(
+            "SELECT data FROM sessions WHERE user_id = ? AND updated_at > ?",
+            (user_id, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _set(self, user_id: int, data: dict):
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (user_id, json.dumps(data, ensure_ascii=False), time.time()))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._purge()
+
+    def _update(self, user_id: int, fields: dict):
+        data = self._get(user_id)
+        data.update(fields)
+        self._set(user_id, data)
+
+    def _purge(self):
+        with self._db:
+            self._db.execute("DELETE FROM sessions WHERE updated_at <= ?", (time.time() - self.ttl,))
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import time
+from typing import Optional
+
+
+class SupportRelayStore:
+    """Соответствие сообщений в чате поддержки пользователям, от которых они пришли.
+
+    Для каждого сообщения, пересланного ботом в чат поддержки, хранится ID
+    пользователя. По ответу на такое сообщение бот находит получателя, даже если
+    настройки приватности пользователя скрывают автора пересланных сообщений.
+    Записи старше ``ttl`` секунд периодически удаляются.
+    """
+
+    # Как часто удалять устаревшие записи, в числе записей
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, ttl: float):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self._writes = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS support_messages (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        """)
+        self._db.commit()
+        self.purge()
+
+    def record(self, chat_id: int, message_id: int, user_id: int):
+        """Запоминает, что сообщение ``message_id`` в чате ``chat_id`` пришло от ``user_id``."""
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO support_messages (chat_id, message_id, user_id, created_at) "
+                "VALUES (?, ?, ?, ?)", (chat_id, message_id, user_id, time.time()))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def lookup(self, chat_id: int, message_id: int) -> Optional[int]:
+        """Возвращает ID пользователя, от которого пришло сообщение, или None."""
+        row = self._db.execute(
+            "SELECT user_id FROM support_messages WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id)).fetchone()
+        return row[0] if row else None
+
+    def purge(self):
+        """Удаляет устаревшие записи."""
+        with self._db:
+            self._db.execute("DELETE FROM support_messages WHERE created_at <= ?", (time.time() - self.ttl,))